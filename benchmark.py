@@ -0,0 +1,310 @@
+"""
+Project: IPP Project 1
+File: benchmark.py
+Title: IPPcode19 interpreter benchmarks
+Description: Generates IPPcode19 programs in XML representation and measures how fast interpret.py runs them
+Author: Michal Pospíšil (xpospi95@stud.fit.vutbr.cz)
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class ProgramWriter:
+    '''Generator of IPPcode19 XML
+
+       Collects instructions and writes them to a file in the XML representation accepted by interpret.py. Order
+       attributes are assigned automatically.
+    '''
+    def __init__(self):
+        '''ProgramWriter constructor
+
+           Creates an empty program.
+        '''
+        self.lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<program language="IPPcode19">']
+        self.order = 0
+
+    def add(self, opcode, *args):
+        '''Appends an instruction
+
+           @param opcode Instruction opcode
+           @param args Arguments as (type, text) pairs
+        '''
+        self.order += 1
+        self.lines.append('  <instruction order="{}" opcode="{}">'.format(self.order, opcode))
+        for (idx, (arg_type, text)) in enumerate(args, start=1):
+            self.lines.append('    <arg{0} type="{1}">{2}</arg{0}>'.format(idx, arg_type, text))
+        self.lines.append('  </instruction>')
+
+    def write(self, path):
+        '''Writes the program to a file
+
+           @param path Path of the created XML file
+        '''
+        with open(path, "w") as xml_file:
+            xml_file.write("\n".join(self.lines + ['</program>']) + "\n")
+
+
+def counted_loop(iterations, body, variables=(), setup=None):
+    '''Builds a loop that executes instructions from body the given number of times
+
+       @param iterations Number of iterations
+       @param body Function that takes a ProgramWriter and adds the loop body to it
+       @param variables Names of additional variables defined before the loop
+       @param setup Function that takes a ProgramWriter and adds instructions executed before the loop
+       @return Instance of ProgramWriter
+    '''
+    writer = ProgramWriter()
+    for name in ("GF@i",) + tuple(variables):
+        writer.add("DEFVAR", ("var", name))
+    if setup is not None:
+        setup(writer)
+    writer.add("MOVE", ("var", "GF@i"), ("int", "0"))
+    writer.add("LABEL", ("label", "_loop"))
+    body(writer)
+    writer.add("ADD", ("var", "GF@i"), ("var", "GF@i"), ("int", "1"))
+    writer.add("JUMPIFNEQ", ("label", "_loop"), ("var", "GF@i"), ("int", str(iterations)))
+
+    return writer
+
+
+def run_program(interpreter, writer, repeat, args=()):
+    '''Runs a generated program and measures the wall time
+
+       @param interpreter Path to the tested interpret.py
+       @param writer ProgramWriter with the program
+       @param repeat Number of runs, the fastest one is taken
+       @param args Additional arguments of the interpreter
+       @return Time of the fastest run in seconds
+    '''
+    (handle, path) = tempfile.mkstemp(suffix=".xml")
+    os.close(handle)
+    try:
+        writer.write(path)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, interpreter, "--source=" + path] + list(args),
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            if completed.returncode != 0:
+                print("benchmark.py: Interpreter returned", completed.returncode, file=sys.stderr)
+                sys.exit(1)
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        os.remove(path)
+
+    return best
+
+
+def bench_dispatch(options):
+    '''Per-instruction dispatch overhead
+
+       Runs the same loop with and without a block of LABEL instructions. LABEL does nothing, so the difference between
+       the runs divided by the number of executed labels is the cost of fetching and dispatching one instruction.
+    '''
+    labels = 20
+
+    def padded(writer):
+        for idx in range(labels):
+            writer.add("LABEL", ("label", "_pad" + str(idx)))
+
+    empty = run_program(options.interpreter, counted_loop(options.iterations, lambda writer: None), options.repeat)
+    full = run_program(options.interpreter, counted_loop(options.iterations, padded), options.repeat)
+    executed = options.iterations * labels
+    print("dispatch: {:.3f} us per instruction ({} instructions, {:.3f} s)".format(
+        (full - empty) / executed * 1e6, executed, full - empty))
+
+
+def bench_loop(options):
+    '''Loop throughput
+
+       Runs a loop made of the typical increment, comparison and conditional jump, the patterns that are fused into
+       single dispatches at load time. Reported time includes the interpreter start-up.
+    '''
+    writer = ProgramWriter()
+    writer.add("DEFVAR", ("var", "GF@i"))
+    writer.add("DEFVAR", ("var", "GF@c"))
+    writer.add("MOVE", ("var", "GF@i"), ("int", "0"))
+    writer.add("LABEL", ("label", "_loop"))
+    writer.add("ADD", ("var", "GF@i"), ("var", "GF@i"), ("int", "1"))
+    writer.add("LT", ("var", "GF@c"), ("var", "GF@i"), ("int", str(options.iterations)))
+    writer.add("JUMPIFEQ", ("label", "_loop"), ("var", "GF@c"), ("bool", "true"))
+
+    elapsed = run_program(options.interpreter, writer, options.repeat)
+    print("loop: {:.3f} us per iteration ({} iterations, {:.3f} s)".format(
+        elapsed / options.iterations * 1e6, options.iterations, elapsed))
+
+
+def bench_stack(options):
+    '''Stack instructions against frame instructions
+
+       Evaluates the same expression (i + 3) * (i - 1) in a loop, once with three-address instructions and temporary
+       variables and once with the STACK extension instructions.
+    '''
+    def frame_body(writer):
+        writer.add("ADD", ("var", "GF@a"), ("var", "GF@i"), ("int", "3"))
+        writer.add("SUB", ("var", "GF@b"), ("var", "GF@i"), ("int", "1"))
+        writer.add("MUL", ("var", "GF@t"), ("var", "GF@a"), ("var", "GF@b"))
+
+    def stack_body(writer):
+        writer.add("PUSHS", ("var", "GF@i"))
+        writer.add("PUSHS", ("int", "3"))
+        writer.add("ADDS")
+        writer.add("PUSHS", ("var", "GF@i"))
+        writer.add("PUSHS", ("int", "1"))
+        writer.add("SUBS")
+        writer.add("MULS")
+        writer.add("POPS", ("var", "GF@t"))
+
+    empty = run_program(options.interpreter, counted_loop(options.iterations, lambda writer: None), options.repeat)
+    for (name, body) in (("frame", frame_body), ("stack", stack_body)):
+        writer = counted_loop(options.iterations, body, ("GF@a", "GF@b", "GF@t"))
+        elapsed = run_program(options.interpreter, writer, options.repeat) - empty
+        print("stack: {} instructions {:.3f} us per expression ({} iterations, {:.3f} s)".format(
+            name, elapsed / options.iterations * 1e6, options.iterations, elapsed))
+
+
+def bench_strings(options):
+    '''String building
+
+       Builds a string of the length given by the number of iterations one character at a time with CONCAT, then
+       overwrites every character with SETCHAR. Both loops were quadratic with immutable strings.
+    '''
+    def concat_body(writer):
+        writer.add("CONCAT", ("var", "GF@s"), ("var", "GF@s"), ("string", "a"))
+
+    def setchar_body(writer):
+        writer.add("SETCHAR", ("var", "GF@s"), ("var", "GF@i"), ("string", "b"))
+
+    def setup(length):
+        return lambda writer: writer.add("MOVE", ("var", "GF@s"), ("string", "a" * length))
+
+    empty = run_program(options.interpreter, counted_loop(options.iterations, lambda writer: None), options.repeat)
+    for (name, body, length) in (("CONCAT", concat_body, 0), ("SETCHAR", setchar_body, options.iterations)):
+        writer = counted_loop(options.iterations, body, ("GF@s",), setup(length))
+        elapsed = run_program(options.interpreter, writer, options.repeat) - empty
+        print("strings: {} {:.3f} us per character ({} characters, {:.3f} s)".format(
+            name, elapsed / options.iterations * 1e6, options.iterations, elapsed))
+
+
+def bench_load(options):
+    '''Loading of large programs
+
+       Generates a program with the given number of instructions that exits right away, so the measured time is
+       parsing and checking of the XML and compilation. The program cache is disabled.
+    '''
+    writer = ProgramWriter()
+    writer.add("EXIT", ("int", "0"))
+    writer.add("DEFVAR", ("var", "GF@x"))
+    writer.add("DEFVAR", ("var", "LF@tmp_1"))
+    instructions = [
+        ("MOVE", ("var", "GF@x"), ("string", "a\\032string\\035with\\092escapes")),
+        ("ADD", ("var", "LF@tmp_1"), ("var", "GF@x"), ("int", "-42")),
+        ("CONCAT", ("var", "GF@x"), ("var", "GF@x"), ("string", "text")),
+        ("JUMPIFEQ", ("label", "_end"), ("var", "GF@x"), ("bool", "true")),
+        ("WRITE", ("nil", "nil")),
+    ]
+    for idx in range(options.instructions - 4):
+        writer.add(*instructions[idx % len(instructions)])
+    writer.add("LABEL", ("label", "_end"))
+
+    elapsed = run_program(options.interpreter, writer, options.repeat, ["--no-cache"])
+    print("load: {:.3f} us per instruction ({} instructions, {:.3f} s)".format(
+        elapsed / options.instructions * 1e6, options.instructions, elapsed))
+
+
+def bench_tier(options):
+    '''Compiled basic blocks
+
+       Runs a loop with arithmetic, comparisons and string operations on global variables, once interpreted and once
+       with hot blocks compiled to Python functions (the default threshold).
+    '''
+    def body(writer):
+        writer.add("ADD", ("var", "GF@a"), ("var", "GF@i"), ("int", "3"))
+        writer.add("SUB", ("var", "GF@b"), ("var", "GF@i"), ("int", "1"))
+        writer.add("MUL", ("var", "GF@t"), ("var", "GF@a"), ("var", "GF@b"))
+        writer.add("GT", ("var", "GF@c"), ("var", "GF@t"), ("int", "100"))
+        writer.add("AND", ("var", "GF@c"), ("var", "GF@c"), ("bool", "true"))
+        writer.add("CONCAT", ("var", "GF@s"), ("string", "a"), ("string", "b"))
+        writer.add("MOVE", ("var", "GF@t"), ("var", "GF@s"))
+
+    writer = counted_loop(options.iterations, body, ("GF@a", "GF@b", "GF@t", "GF@c", "GF@s"))
+    for (name, args) in (("interpreted", ["--tier-threshold=0"]), ("compiled", [])):
+        elapsed = run_program(options.interpreter, writer, options.repeat, args)
+        print("tier: {} {:.3f} us per iteration ({} iterations, {:.3f} s)".format(
+            name, elapsed / options.iterations * 1e6, options.iterations, elapsed))
+
+
+def bench_types(options):
+    '''Inferred operand types
+
+       Runs the same arithmetic and comparisons on variables that only ever hold ints and on variables that also get a
+       string before the loop, so their types can't be proven and every instruction checks them. Both loops are
+       measured interpreted and with compiled blocks.
+    '''
+    def body(writer):
+        writer.add("ADD", ("var", "GF@a"), ("var", "GF@a"), ("var", "GF@i"))
+        writer.add("MUL", ("var", "GF@b"), ("var", "GF@a"), ("int", "3"))
+        writer.add("SUB", ("var", "GF@b"), ("var", "GF@b"), ("var", "GF@a"))
+        writer.add("LT", ("var", "GF@c"), ("var", "GF@b"), ("var", "GF@a"))
+        writer.add("EQ", ("var", "GF@c"), ("var", "GF@b"), ("int", "0"))
+
+    def setup(proven):
+        def add(writer):
+            if not proven:
+                for name in ("GF@a", "GF@b"):
+                    writer.add("MOVE", ("var", name), ("string", "x"))
+            for name in ("GF@a", "GF@b"):
+                writer.add("MOVE", ("var", name), ("int", "0"))
+        return add
+
+    for proven in (True, False):
+        writer = counted_loop(options.iterations, body, ("GF@a", "GF@b", "GF@c"), setup(proven))
+        for (name, args) in (("interpreted", ["--tier-threshold=0"]), ("compiled", [])):
+            elapsed = run_program(options.interpreter, writer, options.repeat, args)
+            print("types: {} {} {:.3f} us per iteration ({} iterations, {:.3f} s)".format(
+                "proven" if proven else "checked", name, elapsed / options.iterations * 1e6, options.iterations,
+                elapsed))
+
+
+# Available benchmarks, name is used on the command line
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "load": bench_load,
+    "loop": bench_loop,
+    "stack": bench_stack,
+    "strings": bench_strings,
+    "tier": bench_tier,
+    "types": bench_types,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the IPPcode19 interpreter.")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help="benchmarks to run, one of: " + ", ".join(sorted(BENCHMARKS)) + " (all by default)")
+    parser.add_argument("--interpreter", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              "interpret.py"),
+                        help="path to the tested interpret.py, use an older copy to compare")
+    parser.add_argument("--iterations", type=int, default=20000, help="number of loop iterations")
+    parser.add_argument("--instructions", type=int, default=1000000,
+                        help="number of instructions of generated programs (load)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the fastest one is reported")
+    options = parser.parse_args()
+
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark " + name)
+
+    for name in options.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](options)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,149 @@ Description: This is an interpreter of IPPcode19 in XML representation
 Author: Michal Pospíšil (xpospi95@stud.fit.vutbr.cz)
 """
 
-from copy import deepcopy
+import gc
 import getopt
-import itertools
+import hashlib
+import io
+import json
+import operator
+import marshal
+import mmap
+import os
+import stat
 import sys
 import re
+import tempfile
+import time
+import traceback
 import xml.etree.ElementTree as xml_et
-import codecs
+import collections
+import signal
+import socket
+from types import MethodType
+
+
+class InterpretError(Exception):
+    '''Error that ends interpretation
+
+       Raised by the loader and by instructions instead of ending the process, so one run can fail without affecting
+       others in the same process. Carries the return code defined by the IPPcode19 specification.
+    '''
+    def __init__(self, code, message, order=None):
+        '''InterpretError constructor
+
+           @param code Return code of the interpreter
+           @param message Description of the error
+           @param order Order tag of the instruction that caused the error (None when it's not known)
+        '''
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.order = order
+
+    def __str__(self):
+        if self.order is None:
+            return self.message
+
+        return "{}: {}".format(self.order, self.message)
+
+
+class XMLFormatError(InterpretError):
+    '''Source isn't well-formed XML (return code 31)'''
+    def __init__(self, message, order=None):
+        super().__init__(31, message, order)
+
+
+class XMLStructureError(InterpretError):
+    '''Unexpected XML structure or lexical and syntax errors in instructions (return code 32)'''
+    def __init__(self, message, order=None):
+        super().__init__(32, message, order)
+
+
+class SemanticError(InterpretError):
+    '''Semantic error, e.g. undefined label or redefinition of a variable (return code 52)'''
+    def __init__(self, message, order=None):
+        super().__init__(52, message, order)
+
+
+class OperandTypeError(InterpretError):
+    '''Operands of wrong types (return code 53)'''
+    def __init__(self, message, order=None):
+        super().__init__(53, message, order)
+
+
+class UndefinedVariableError(InterpretError):
+    '''Access to a variable that doesn't exist in an existing frame (return code 54)'''
+    def __init__(self, message, order=None):
+        super().__init__(54, message, order)
+
+
+class FrameError(InterpretError):
+    '''Frame doesn't exist (return code 55)'''
+    def __init__(self, message, order=None):
+        super().__init__(55, message, order)
+
+
+class MissingValueError(InterpretError):
+    '''Missing value in a variable, on the data stack or on the call stack (return code 56)'''
+    def __init__(self, message, order=None):
+        super().__init__(56, message, order)
+
+
+class OperandValueError(InterpretError):
+    '''Wrong operand value, e.g. division by zero or invalid return code of EXIT (return code 57)'''
+    def __init__(self, message, order=None):
+        super().__init__(57, message, order)
+
+
+class StringError(InterpretError):
+    '''Wrong string operation, e.g. index out of range (return code 58)'''
+    def __init__(self, message, order=None):
+        super().__init__(58, message, order)
+
+
+class InstructionLimitError(InterpretError):
+    '''Program executes more instructions than allowed by --max-insts (return code 60)'''
+    def __init__(self, message, order=None):
+        super().__init__(60, message, order)
+
+
+class TimeLimitError(InterpretError):
+    '''Program runs longer than allowed by --max-time (return code 61)'''
+    def __init__(self, message, order=None):
+        super().__init__(61, message, order)
+
+
+class CallDepthError(InterpretError):
+    '''Call stack is deeper than allowed by --max-calls (return code 62)'''
+    def __init__(self, message, order=None):
+        super().__init__(62, message, order)
+
+
+class FrameDepthError(InterpretError):
+    '''Local frame stack is deeper than allowed by --max-frames (return code 63)'''
+    def __init__(self, message, order=None):
+        super().__init__(63, message, order)
+
+
+class StringSizeError(InterpretError):
+    '''String is longer than allowed by --max-string (return code 64)'''
+    def __init__(self, message, order=None):
+        super().__init__(64, message, order)
+
+
+class ProgramExit(Exception):
+    '''Program end requested by instruction EXIT
+
+       Carries the return code given to the instruction.
+    '''
+    def __init__(self, code):
+        '''ProgramExit constructor
+
+           @param code Return code of the program
+        '''
+        super().__init__(code)
+        self.code = code
 
 
 class FrameSet:
@@ -21,229 +157,283 @@ class FrameSet:
        This class implements global and temporary frame. It also contains local frame stack. Frames are implemented as
        separate classes. Global frame is the only defined frame at program start.
     '''
-    def __init__(self):
+    def __init__(self, global_names=(), local_names=()):
         '''Frameset constructor
 
-           Initializes global frame and creates empty local frame stack and undefined temporary frame.
+           Initializes global frame and creates empty local frame stack and undefined temporary frame. Slot layouts are
+           computed by Program.compile from DEFVAR instructions.
+           @param global_names Identifiers of global variables, index in the list is the slot number
+           @param local_names Identifiers of temporary and local variables, index in the list is the slot number
         '''
+        self.global_names = list(global_names)
+        self.local_names = list(local_names)
         self.local_frame_stack = []
-        self.global_frame = Frame("global")
+        self.global_frame = Frame("global", self.global_names)
         self.temporary_frame = None
+        self.frame_pool = []  # Discarded temporary frames that can be reused
+        self.initialized = 0  # Number of initialized variables in all frames
+        self.max_initialized = 0  # Maximum of initialized during the execution (--vars)
+        self.max_frames = sys.maxsize  # Maximum depth of the local frame stack (--max-frames)
 
     def init_temporary_frame(self):
         '''Initializes the temporary frame
 
-            Creates a new instance of a temporary frame. Rewrites the existing temporary frame.
+            Creates a new empty temporary frame. Rewrites the existing temporary frame, which is recycled to the frame
+            pool. Frames are taken from the pool when possible, so recursive code doesn't allocate a frame per call.
+        '''
+        self.discard_temporary()
+
+        if self.frame_pool:
+            self.temporary_frame = self.frame_pool.pop()
+        else:
+            self.temporary_frame = Frame("temporary", self.local_names)
+
+    def discard_temporary(self):
+        '''Throws away the temporary frame
+
+           The frame is cleared and put to the frame pool. Nothing else references it - frames are moved between the
+           temporary frame and the local frame stack, never copied.
         '''
-        self.temporary_frame = Frame("temporary")
+        if self.temporary_frame is not None:
+            self.initialized -= self.temporary_frame.initialized
+            self.temporary_frame.clear()
+            self.frame_pool.append(self.temporary_frame)
+            self.temporary_frame = None
 
-    def set_var(self, name):
+    def set_var(self, ref):
         '''Defines a variable
 
            Creates an empty variable on a frame defined in variable's name. This function calls a function with the
            same name defined in class frame.
-           @param name Name of variable in format (TF|LF|GF)@<var_name>
-        :return:
+           @param ref Instance of class VarRef that references the variable
         '''
-        exploded = re.split(r'@', name, maxsplit=1)
-        scope = exploded[0]
-        identifier = exploded[1]
+        scope = ref.scope
+        identifier = ref.identifier
 
         if scope == "GF":
-            self.global_frame.set_var(identifier)
+            self.global_frame.set_var(ref)
 
         elif scope == "TF":
             if self.temporary_frame is None:
-                print("interpret.py: Temporary frame is not defined.", file=sys.stderr)
-                sys.exit(55)
+                raise FrameError("Temporary frame is not defined.")
 
-            self.temporary_frame.set_var(identifier)
+            self.temporary_frame.set_var(ref)
 
         elif scope == "LF":
             try:
-                self.local_frame_stack[-1].set_var(identifier)
+                self.local_frame_stack[-1].set_var(ref)
             except IndexError:
-                print("interpret.py: Local frame stack is empty.", file=sys.stderr)
-                sys.exit(55)
+                raise FrameError("Local frame stack is empty.")
 
         else:
-            print("interpret.py: Unrecognized scope.", file=sys.stderr)
-            sys.exit(55)
+            raise FrameError("Unrecognized scope.")
 
-    def update_var(self, name, value, order):
+    def update_var(self, ref, value, order):
         '''Change value of a variable
 
            Changes value of a variable on the frame defined in variable's name. Any value is supported, current type
-           of variable is unimportant.
-           @param name Name of variable in format (TF|LF|GF)@<var_name>
+           of variable is unimportant. First write to a variable is counted in the number of initialized variables.
+           @param ref Instance of class VarRef that references the variable
            @param value Value to be written to the variable (in IPPcode19 syntax)
            @param order Order tag of the invoking instruction - used for error reporting
         '''
-        exploded = re.split(r'@', name, maxsplit=1)
-        scope = exploded[0]
-        identifier = exploded[1]
+        scope = ref.scope
+        identifier = ref.identifier
 
         if scope == "GF":
             try:
-                self.global_frame.update_var(identifier, value)
+                initialized = self.global_frame.update_var(ref, value)
             except KeyError:
-                print("interpret.py:", order, ": Variable ", identifier, " doesn't exist.", file=sys.stderr, sep='')
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist.".format(identifier), order)
 
         elif scope == "TF":
             if self.temporary_frame is None:
-                print("interpret.py:", order, ": Temporary frame is not defined.", file=sys.stderr, sep='')
-                sys.exit(55)
+                raise FrameError("Temporary frame is not defined.", order)
 
             try:
-                self.temporary_frame.update_var(identifier, value)
+                initialized = self.temporary_frame.update_var(ref, value)
             except KeyError:
-                print("interpret.py:", order, ": Variable ", identifier, " doesn't exist.", file=sys.stderr, sep='')
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist.".format(identifier), order)
 
         elif scope == "LF":
             try:
-                self.local_frame_stack[-1].update_var(identifier, value)
+                initialized = self.local_frame_stack[-1].update_var(ref, value)
             except IndexError:
-                print("interpret.py:", order, ": Local frame stack is empty.", file=sys.stderr, sep='')
-                sys.exit(55)
+                raise FrameError("Local frame stack is empty.", order)
             except KeyError:
-                print("interpret.py:", order, ": Variable ", identifier, " doesn't exist.", file=sys.stderr, sep='')
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist.".format(identifier), order)
+
+        else:
+            return
 
-    def get_var(self, name, order):
+        if initialized:
+            self.initialized += 1
+            if self.initialized > self.max_initialized:
+                self.max_initialized = self.initialized
+
+    def get_var(self, ref, order):
         '''Get variable as an object
 
            Function returns an instance of class Variable that was created during parsing and it's saved in the frame
            defined in variable's name.
-           @param name Name of variable in format (TF|LF|GF)@<var_name>
+           @param ref Instance of class VarRef that references the variable
            @param order Order tag of the invoking instruction - used for error reporting
            @return Variable instance of class Variable
         '''
-        exploded = re.split(r'@', name, maxsplit=1)
-        scope = exploded[0]
-        identifier = exploded[1]
+        scope = ref.scope
+        identifier = ref.identifier
 
         if scope == "GF":
             try:
-                retval = self.global_frame.get_var(identifier)
+                retval = self.global_frame.get_var(ref)
             except KeyError:
-                print("interpret.py:", order, ": Variable", identifier, "doesn't exist in the global frame.",
-                      file=sys.stderr)
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist in the global frame.".format(identifier), order)
 
             return retval
 
         elif scope == "TF":
             if self.temporary_frame is None:
-                print("interpret.py:", order, ": Temporary frame is not defined.", file=sys.stderr)
-                sys.exit(55)
+                raise FrameError("Temporary frame is not defined.", order)
 
             try:
-                retval = self.temporary_frame.get_var(identifier)
+                retval = self.temporary_frame.get_var(ref)
             except KeyError:
-                print("interpret.py:", order, ": Variable ", identifier, " doesn't exist in the temporary frame.",
-                      file=sys.stderr, sep='')
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist in the temporary frame.".format(identifier),
+                                             order)
 
             return retval
 
         elif scope == "LF":
             try:
-                retval = self.local_frame_stack[-1].get_var(identifier)
+                retval = self.local_frame_stack[-1].get_var(ref)
             except KeyError:
-                print("interpret.py:", order, ": Variable ", identifier, " doesn't exist in this local frame.",
-                      file=sys.stderr, sep='')
-                sys.exit(54)
+                raise UndefinedVariableError("Variable {} doesn't exist in this local frame.".format(identifier), order)
             except IndexError:
-                print("interpret.py:", order, ": Local frame stack is empty.", file=sys.stderr, sep='')
-                sys.exit(55)
+                raise FrameError("Local frame stack is empty.", order)
 
             return retval
         else:
-            print("interpret.py:", order, ": Unrecognized scope.", file=sys.stderr, sep='')
-            sys.exit(55)
+            raise FrameError("Unrecognized scope.", order)
 
     def push_temp(self, order):
         '''Places temporary frame on top of local frame stack
 
-           Copies the temporary frame to the top of the local frame stack. Variable names donþt need to be updated,
-           as they are stored without a frame name.
+           Moves the temporary frame to the top of the local frame stack without copying it - temporary frame becomes
+           undefined, so nothing else can reach the frame. Variable names donþt need to be updated, as they are stored
+           without a frame name.
            @param order Order tag of the invoking instruction - used for error reporting
         '''
         if self.temporary_frame is None:
-            print("interpret.py:", order, ": Temporary frame is not defined.", file=sys.stderr, sep='')
-            sys.exit(55)
+            raise FrameError("Temporary frame is not defined.", order)
+        if len(self.local_frame_stack) >= self.max_frames:
+            raise FrameDepthError("Local frame stack is deeper than {} frames.".format(self.max_frames), order)
 
-        temp_copy = deepcopy(self.temporary_frame)
-        self.local_frame_stack.append(temp_copy)
+        self.local_frame_stack.append(self.temporary_frame)
         self.temporary_frame = None
 
     def pop_local(self, order):
         '''Pops local frame into the temporary frame
 
-           Takes the top local frame and replaces the temporary frame with it.
+           Takes the top local frame and replaces the temporary frame with it. The replaced temporary frame is recycled
+           to the frame pool.
            @param order Order tag of the invoking instruction - used for error reporting
         '''
-        try:
-            self.temporary_frame = self.local_frame_stack.pop()
-        except IndexError:
-            print("interpret.py:", order, ": Local frame stack is empty.", file=sys.stderr, sep='')
-            sys.exit(55)
+        if not self.local_frame_stack:
+            raise FrameError("Local frame stack is empty.", order)
+
+        self.discard_temporary()
+        self.temporary_frame = self.local_frame_stack.pop()
 
 
 class Frame:
     '''Frame that holds variables
 
-       Variables are stored in a dictionary, where keys are variable names without the frame specification and values
-       are instances of class Variable.
+       Variables are stored in a list of slots. Slot numbers are assigned to identifiers at load time by a pass over
+       all DEFVAR instructions and stored in VarRef operands, so accessing a variable is a list index. An empty slot
+       contains None. Identifiers without a slot number fall back to a dictionary, where keys are variable names without
+       the frame specification. Both contain instances of class Variable.
     '''
-    def __init__(self, scope):
+    def __init__(self, scope, names):
         '''Frame constructor
 
            Creates an empty frame.
            @param scope Takes the scope of the frame: local, global, temporary
+           @param names Identifiers of variables that have a slot, index in the list is the slot number
         '''
         self.scope = scope
+        self.names = names
+        self.slots = [None] * len(names)
         self.vars = {}
+        self.initialized = 0  # Number of variables that have a value
 
-    def set_var(self, identifier):
+    def set_var(self, ref):
         '''Creates a new variable
 
            Creates an instance of class Variable on the frame.
-           @param identifier Name of the variable (without frame)
+           @param ref Instance of class VarRef that references the variable
+           @throws KeyError When the variable already exists
         '''
-        try:
-            self.vars[identifier]
-        except KeyError:
-            self.vars[identifier] = Variable()
-            return
-
-        raise KeyError
+        slot = ref.slot
+        if slot is None:
+            if ref.identifier in self.vars:
+                raise KeyError(ref.identifier)
+            self.vars[ref.identifier] = Variable()
+        else:
+            if self.slots[slot] is not None:
+                raise KeyError(ref.identifier)
+            self.slots[slot] = Variable()
 
-    def update_var(self, identifier, value):
+    def update_var(self, ref, value):
         '''Changes value of a variable
 
-           Calls method of class Varibale on the variable from a dictionary.
-           @param identifier Name of the variable (without frame)
+           Calls method of class Varibale on the variable from a slot.
+           @param ref Instance of class VarRef that references the variable
            @param value Value to write
+           @return True when the variable didn't have a value before
+           @throws KeyError When the variable doesn't exist
         '''
-        try:
-            self.vars[identifier].set_value(value)
-        except KeyError:
-            raise
+        variable = self.get_var(ref)
+        initialized = variable.type == "undefined"
+        variable.set_value(value)
+        if initialized:
+            self.initialized += 1
 
-    def get_var(self, identifier):
+        return initialized
+
+    def get_var(self, ref):
         '''Returns variable object
 
-           Returns reference to the object from the variable dictionary.
-           @param identifier Name of the variable (without frame)
+           Returns reference to the object from the variable slot.
+           @param ref Instance of class VarRef that references the variable
            @return Instance of class Variable
+           @throws KeyError When the variable doesn't exist
         '''
-        try:
-            retval = self.vars[identifier]
-        except KeyError:
-            raise
+        slot = ref.slot
+        if slot is None:
+            return self.vars[ref.identifier]
+
+        retval = self.slots[slot]
+        if retval is None:
+            raise KeyError(ref.identifier)
+
+        return retval
+
+    def clear(self):
+        '''Removes all variables
+
+           Used when the frame is recycled from the frame pool.
+        '''
+        self.slots = [None] * len(self.names)
+        self.vars.clear()
+        self.initialized = 0
+
+    def items(self):
+        '''Lists defined variables
+
+           @return List of pairs of identifier and instance of class Variable
+        '''
+        retval = [(name, variable) for (name, variable) in zip(self.names, self.slots) if variable is not None]
+        retval.extend(self.vars.items())
 
         return retval
 
@@ -253,7 +443,20 @@ class Variable:
 
        This class doesn't conatin the variable's name - itþs stored as the key in variable dictionary that is defined
        in a frame. It stores variable's value and type - IPPcode19 supports dynamic typing.
+
+       Every IPPcode19 type has its own Python type - int is int, bool is bool (never 0 or 1), string is str and nil is
+       None. Instructions check operands with type(value) is ..., isinstance would accept bools as ints.
+
+       String that is built by CONCAT onto the same variable or changed by SETCHAR is kept as a list of characters,
+       so both take time proportional to the change, not to the whole string. Type of such variable is "builder" and
+       the value is out of date until the string is read - materialize joins only the changed range of characters and
+       copies the rest from the old value. STRLEN, GETCHAR and STRI2INT index the list directly.
     '''
+    __slots__ = ("value", "type", "chars", "changed_from", "changed_to")
+
+    # IPPcode19 type of a value, looked up by its Python type
+    type_names = {int: "int", bool: "bool", str: "string", type(None): "nil"}
+
     def __init__(self):
         '''Variable constructor
 
@@ -263,534 +466,1540 @@ class Variable:
         '''
         self.value = ""
         self.type = "undefined"
+        self.chars = None      # List of characters of a string value (when it's being built)
+        self.changed_from = 0  # Range of indices where chars differ from value (empty when from >= to)
+        self.changed_to = 0
 
     def set_value(self, value):
         '''Changes variable's value
 
-           @param value Desired value in IPPcode19 syntax
+           Type is set once here, readers don't need to derive it from the value.
+           @param value Python value of one of the types in type_names
         '''
         self.value = value
-        if isinstance(value, str):
-            self.type = "string"
-
-        if isinstance(value, int):
-            self.type = "int"
-
-        if value in {"bool@true", "bool@false"}:
-            self.type = "bool"
-
-        if value is "nil@nil":
-            self.type = "nil"
+        self.type = self.type_names[type(value)]
+        self.chars = None
 
     def get_type(self):
-        '''Checks the variable type
+        '''Returns the variable type
 
-           @return Type of the variable - int, string, bool, nil
+           @return Type of the variable - int, string, bool, nil or undefined
         '''
-        if self.type == "var":
-            if isinstance(self.value, str):
-                self.type = "string"
+        if self.type == "builder":
+            return "string"
 
-            if isinstance(self.value, int):
-                self.type = "int"
+        return self.type
 
-            if isinstance(self.value, bool):
-                self.type = "bool"
+    def get_value(self):
+        '''Returns the current value
 
-            if self.value is None:
-                self.type = "nil"
-        else:
-            return self.type
+           @return Pythonic value, joined string for a string that is being built
+        '''
+        if self.type == "builder":
+            self.materialize()
 
-    def get_value(self):
         return self.value
 
+    def materialize(self):
+        '''Joins characters of a string that is being built into the value'''
+        (start, end) = (self.changed_from, self.changed_to)
+        self.value = self.value[:start] + "".join(self.chars[start:end]) + self.value[end:]
+        self.type = "string"
+        (self.changed_from, self.changed_to) = (len(self.chars), 0)
 
-def decode_escapes(s):
-    '''Helper function that reverses escaping done by xml.etree
+    def split(self):
+        '''Starts building from the current string value'''
+        self.chars = list(self.value)
+        (self.changed_from, self.changed_to) = (len(self.chars), 0)
 
-       Ideas from https://stackoverflow.com/a/24519338 and https://stackoverflow.com/a/21301416
-       @param s String to be unescaped
-       @return Unescaped string
-       @pre String cannot be empty
-    '''
-    escape_sequence_re = re.compile(r'\\([0-9]{3})', re.UNICODE | re.VERBOSE)
+    def append(self, text):
+        '''Appends to a string in place
 
-    def decode_match(match):
-        return codecs.decode(chr(int(match.group(1))), 'unicode-escape')
+           @param text String appended to the current string value
+        '''
+        if self.chars is None:
+            self.split()
+        if len(self.chars) < self.changed_from:
+            self.changed_from = len(self.chars)
+        self.chars.extend(text)
+        self.changed_to = len(self.chars)
+        self.type = "builder"
+
+    def length(self):
+        '''Length of a string value
+
+           @return Number of characters, the string isn't joined
+        '''
+        if self.chars is None:
+            return len(self.value)
 
-    return escape_sequence_re.sub(decode_match, s)
+        return len(self.chars)
 
+    def set_char(self, idx, char):
+        '''Replaces a character of a string in place
 
-class Program:
-    '''Program class
+           @param idx Index of the character, must be in range
+           @param char New character
+        '''
+        if self.chars is None:
+            self.split()
+        self.chars[idx] = char
+        if idx < self.changed_from:
+            self.changed_from = idx
+        if idx >= self.changed_to:
+            self.changed_to = idx + 1
+        self.type = "builder"
+
+
+class Constant:
+    '''Constant operand
 
-       Program class holds instructions parsed from the xml. To handle jumps, it contains dictionary of labels - keys
-       are labels and values are instruction jump tags. Method execute is used as main loop of the interpreter, so
-       frameset and subsequently frames and variables are stored here for easy access. Member variables order_next
-       and order_jumpto are used to interchange order tags when instructions change control flow - this is a result
-       of flawed design.
+       Immediate value of an instruction argument. The text from the XML is converted to a Python value once, when
+       the instruction is built, so execution only returns the stored value.
     '''
-    def __init__(self, parsed_xml):
-        '''Program constructor
+    __slots__ = ("type", "value")
+
+    def __init__(self, const_type, text):
+        '''Constant constructor
 
-           Creates a new program instance.
-           @param parsed_xml Used to pass ElementTree created by the XML parser
+           @param const_type Type of the constant from the XML - int, bool, string or nil
+           @param text Text of the argument element
+           @throws ValueError When an int constant can't be converted
         '''
-        self.elem_program = parsed_xml  # Root element program as Element from ElementTree
-        self.instructions = {}          # Dictionary of instructions - keys are their order values (iterate sorted)
-        self.labels = {}                # Index names are labels and keys are instruction order values
-        self.name = None                # DEPRECATED: Value of attribute name in element program
-        self.description = None         # DEPRECATED: Value of attribute description in element program
-        self.frameset = FrameSet()      # Frameset instance taht contains frames and variables
-        self.callstack = []             # List of return indices from call instructions to return instructions
-        self.order_next = None          # For passing values to callstack (remembers last next instruction)
-        self.order_jumpto = None        # For passing values from jump instructions to execution loop
-        self.stdin_file = None          # A file object that contains a file when --input argument was given
+        self.type = const_type
+        self.value = text
 
-    def set_input(self, stdin_file):
-        '''Input file
+        if const_type == "int":
+            self.value = int(text)
 
-           Saves a file object with inputs for READ instructions so it can be easily accessed.
-           @param stdin_file A file object with inputs for READ instruction
+        if const_type == "nil":
+            self.value = None
+
+        if const_type == "bool":
+            if text == "true":
+                self.value = True
+
+            if text == "false":
+                self.value = False
+
+    def read(self, frameset, order):
+        '''Returns the value of the constant
+
+           Has the same interface as VarRef.read, so instructions don't need to know the kind of their operands.
+           @param frameset Unused
+           @param order Unused
+           @return Pythonic value of the constant
         '''
-        self.stdin_file = stdin_file
+        return self.value
 
-    def extract_instructions(self):
-        '''XML parser and checker
+    def read_chars(self, frameset, order):
+        '''Returns the value of the constant
 
-           This method reads the ElementTree and checks that is syntactically correct. This implementation supports
-           instructions out-of-order and with non-following order attributes. XML should strictly follow the specifi-
-           cation, invalid values and unsupported elements raise an error. XML comments are allowed.
+           Has the same interface as VarRef.read_chars.
+           @return Pythonic value of the constant
         '''
-        # Check program attributes
-        program_attr = self.elem_program.attrib
-        ## Language attribute
-        try:
-            language = program_attr.pop("language")
-        except KeyError:
-            print("interpret.py: Program element is missing a language attribute.", file=sys.stderr)
-            sys.exit(32)
-        if language.lower() != "ippcode19":
-            print("interpret.py: Program element contains an incorrect language attribute.", file=sys.stderr)
-            sys.exit(32)
-        ## Test for allowed attributes
-        allowed_program_attr = {"language", "name", "description"}
-        for program_attr in program_attr.keys():
-            if program_attr not in allowed_program_attr:
-                print("interpret.py: Invalid attribute in the program element.", file=sys.stderr)
-                sys.exit(32)
-
-        # Checking instructions
-        for (idx, instruction) in enumerate(self.elem_program.findall("*"), start=1):
-            # No instruction elements
-            if instruction is None:
-                print("interpret.py: No instruction elements found.", file=sys.stderr)
-                sys.exit(32)
-
-            # Check that only children are instruction elements
-            if instruction.tag != "instruction":
-                print("interpret.py: Invalid child element in the program element.", file=sys.stderr)
-                sys.exit(32)
-
-            # Extracting instruction attributes
-            instruction_attr = instruction.attrib
-            ## Get order number
-            try:
-                order = instruction_attr.pop("order")
-            except KeyError:
-                print("interpret.py:", idx, ": Undefined order attribute. (Order of element in document is "
-                      "provided here)", file=sys.stderr, sep='')
-                sys.exit(32)
-            ### Convert to int and check value
-            try:
-                order = int(order)
-            except ValueError:
-                print("interpret.py:", idx, ": Order attribute contains an invalid value. (Order of element in "
-                      "document is provided here)", file=sys.stderr, sep='')
-                sys.exit(32)
+        return self.value
 
-            ## Get opcode
-            try:
-                opcode = instruction_attr.pop("opcode").upper()
-            except KeyError:
-                print("interpret.py:", order, ": Undefined opcode attribute in instruction ", order, '.',
-                      file=sys.stderr, sep='')
-                sys.exit(32)
-
-            # Getting and checking arguments - at baseline, none are defined
-            arg1 = None
-            arg1_type = None
-            arg2 = None
-            arg2_type = None
-            arg3 = None
-            arg3_type = None
-            allowed_arg_tags = {'arg1': None, 'arg2': None, 'arg3': None}
-            for argument in instruction.findall("*"):
-                # Trying to pop from dictionary with arg tags - fails on unknown and duplicate elements
-                try:
-                    allowed_arg_tags.pop(argument.tag)
-                except KeyError:
-                    print("interpret.py:", order, ": Too many, duplicate arguments or unrecognized child elements.",
-                          file=sys.stderr, sep='')
-                    sys.exit(32)
-
-                # Checking argument attributes
-                arg_attr = argument.attrib
-                try:
-                    attr_type = arg_attr.pop("type")
-                except KeyError:
-                    print("interpret.py:", order, ": Attribute type is missing.",
-                          file=sys.stderr, sep='')
-                    sys.exit(32)
-
-                # Check attribute type and convert to lowercase
-
-                ## Element without text returns has text set to None - treating here
-                arg_text = argument.text
-                if arg_text is None:
-                    arg_text = ""
-                else:
-                    # Repairing escape sequences that have escaped backslashes by xml.etree
-                    arg_text = decode_escapes(arg_text)
 
-                # Insert argument and type into the instruction
-                if argument.tag == "arg1":
-                    arg1 = arg_text
-                    arg1_type = attr_type
+class VarRef:
+    '''Variable operand
 
-                if argument.tag == "arg2":
-                    arg2 = arg_text
-                    arg2_type = attr_type
+       Reference to a variable in an instruction argument. Variable name is split into the frame and the identifier
+       once, when the instruction is built.
+    '''
+    __slots__ = ("name", "scope", "identifier", "slot")
+
+    def __init__(self, name):
+        '''VarRef constructor
 
-                if argument.tag == "arg3":
-                    arg3 = arg_text
-                    arg3_type = attr_type
+           @param name Name of variable in format (TF|LF|GF)@<var_name>
+        '''
+        self.name = name
+        (self.scope, _, self.identifier) = name.partition("@")
+        self.slot = None  # Index of the variable in frame slots (assigned by Program.compile)
 
-                # Build label dictionary
-                if opcode == "LABEL":
-                    self.labels[arg1] = order
+    def read(self, frameset, order):
+        '''Get value of a variable
 
-            self.instructions[order] = Instruction(order, opcode, arg1, arg2, arg3, arg1_type, arg2_type, arg3_type)
+           Gets the value of a variable on runtime. Checks if it's defined otherwise raises an error.
+           @param frameset Instance of FrameSet that holds the variable
+           @param order Order tag of invoking instruction (for error reporting)
+           @return Pythonic variable value
+        '''
+        variable = frameset.get_var(self, order)
+        if variable.type == "undefined":
+            raise MissingValueError("Variable {} is undefined.".format(self.name), order)
+        if variable.type == "builder":
+            variable.materialize()
 
-    def execute(self):
-        '''Main interpreter loop
+        return variable.value
 
-           This method implements executing the instructions in the interpreter.
+    def read_chars(self, frameset, order):
+        '''Get value of a variable for indexing
+
+           Same as read, but a string that is being built is returned as the list of its characters instead of being
+           joined. Length and indexing of the list are the same as of the string.
+           @param frameset Instance of FrameSet that holds the variable
+           @param order Order tag of invoking instruction (for error reporting)
+           @return Pythonic variable value or list of characters
         '''
-        instruction_keys = sorted(self.instructions.keys())
-        instruction_key = min(instruction_keys)
-        end = True
+        variable = frameset.get_var(self, order)
+        if variable.type == "undefined":
+            raise MissingValueError("Variable {} is undefined.".format(self.name), order)
+        if variable.type == "builder":
+            return variable.chars
 
-        while end:
-            # Find next instruction key (can be bigger than +1) in case that call instruction is called
-            try:
-                self.order_next = instruction_keys[instruction_keys.index(instruction_key) + 1]
-            except IndexError:
-                end = False
+        return variable.value
 
-            # Passing program instance because instructions need to change frames, variables, etc.
-            self.instructions[instruction_key].execute(self)
 
-            if self.order_jumpto is None:
-                # Update instruction key with original next value
-                instruction_key = self.order_next
-            else:
-                # Jump/return instruction was performed, next order is determined by order_jumpto
-                instruction_key = self.order_jumpto
-                self.order_jumpto = None
+# Characters of escape sequences \000 to \999 by their digits
+ESCAPE_TABLE = {"{:03d}".format(code): chr(code) for code in range(1000)}
 
 
-class Instruction:
-    """Instruction representation
+def decode_escapes(s):
+    '''Decodes escape sequences of a string literal
 
-       Implements the instruction syntax checking and the actual implementation of every instruction in methods instr_*.
-    """
+       Sequence \\ddd is the character with decimal code ddd. The text is split at backslashes and every part after
+       one starts with the three digits, so each sequence is one lookup in ESCAPE_TABLE. Strings without a backslash
+       are returned as they are.
+       @param s String literal with valid escape sequences (checked by Schema)
+       @return Unescaped string
+    '''
+    if "\\" not in s:
+        return s
 
-    accepted_const = {"int", "bool", "string", "nil"}  # Strings that are accepted as type
+    parts = s.split("\\")
+    return parts[0] + "".join([ESCAPE_TABLE[part[:3]] + part[3:] for part in parts[1:]])
 
-    def __init__(self, order, name, arg1, arg2, arg3, arg1_type, arg2_type, arg3_type):
-        """Instruction constructor
 
-           Takes the order tag for error reporting, opcode and arguments along with types from the XML.
-        """
-        self.order = order
-        self.name = name
-        self.argv = []
-        self.arg_types = []
-        if arg1_type:
-            self.argv.append(arg1)
-            self.arg_types.append(arg1_type)
-        if arg2_type:
-            self.argv.append(arg2)
-            self.arg_types.append(arg2_type)
-        if arg3_type:
-            self.argv.append(arg3)
-            self.arg_types.append(arg3_type)
+class InputReader:
+    '''Buffered reader of inputs for READ
+
+       Regular files are memory mapped and lines are cut out of the mapping by searching for the next newline from
+       the current offset, so no per-line read call or exception handling is needed. Other streams (pipes, terminals)
+       are read in large chunks that are split into lines at once. Chunks are read with read1, which returns as soon as
+       some data is available, so interactive input isn't delayed. Lines are returned without the trailing newline,
+       None is returned at the end of input.
+    '''
+    def __init__(self, file, chunk_size=65536):
+        '''InputReader constructor
+
+           @param file File object with inputs for READ instruction
+           @param chunk_size Number of bytes read from a stream at once
+        '''
+        self.file = file
+        self.chunk_size = chunk_size
+        self.data = None     # Memory mapped content of a regular file
+        self.position = 0    # Offset of the next line in data
+        self.lines = []      # Lines read from a stream that weren't returned yet (in reversed order)
+        self.rest = b""      # Incomplete last line of the last chunk
+        self.eof = False     # Stream has no more chunks
 
-        param_values = {
-            # 0 ARGUMENTS
-            'CREATEFRAME': "[]",
-            'PUSHFRAME': "[]",
-            'POPFRAME': "[]",
-            'RETURN': "[]",
-            'BREAK': "[]",
-            # 1 ARGUMENT
-            'DEFVAR': "['var']",
-            'CALL': "['label']",
-            'PUSHS': "['symb']",
-            'POPS': "['var']",
-            'WRITE': "['symb']",
-            'LABEL': "['label']",
-            'JUMP': "['label']",
-            'EXIT': "['symb']",
-            'DPRINT': "['symb']",
-            # 2 ARGUMENTS
-            'MOVE': "['var', 'symb']",
-            'INT2CHAR': "['var', 'symb']",
-            'READ': "['var', 'type']",
-            'STRLEN': "['var', 'symb']",
-            'TYPE': "['var', 'symb']",
-            # 3 ARGUMENTS
-            'ADD': "['var','symb','symb']",
-            'SUB': "['var','symb','symb']",
-            'MUL': "['var','symb','symb']",
-            'IDIV': "['var','symb','symb']",
-            'LT': "['var','symb','symb']",
-            'GT': "['var','symb','symb']",
-            'EQ': "['var','symb','symb']",
-            'AND': "['var','symb','symb']",
-            'OR': "['var','symb','symb']",
-            'NOT': "['var','symb','symb']",
-            'STRI2INT': "['var','symb','symb']",
-            'CONCAT': "['var','symb','symb']",
-            'GETCHAR': "['var','symb','symb']",
-            'SETCHAR': "['var','symb','symb']",
-            'JUMPIFEQ': "['label','symb','symb']",
-            'JUMPIFNEQ': "['label','symb','symb']"
-        }
         try:
-            # eval expands to a list assignment based on the opcode
-            self.expected_arg_types = eval(param_values[name])
-        except KeyError:
-            print("interpret.py:", order, ": Unknown instruction name.", file=sys.stderr, sep='')
-            sys.exit(32)
-
-        # PREEMPTIVE TYPE CHECKING
-        accepted_as_symb = {"int", "bool", "string", "nil", "var"}
-        arg_num = 0
-        for arg_type, expected_arg_type in itertools.zip_longest(self.arg_types, self.expected_arg_types):
-            arg_num = arg_num + 1
-            if arg_type != expected_arg_type:
-                if expected_arg_type == "symb" and arg_type in accepted_as_symb:
-                    pass
-                else:
-                    print("interpret.py:", self.order, ": Argument ", arg_num, " in instruction has incorrect type.",
-                          file=sys.stderr, sep='')
-                    sys.exit(32)
+            fileno = file.fileno()
+            file_stat = os.fstat(fileno)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # Not backed by a file descriptor (e.g. io.StringIO)
+            return
 
-        self.check_arg_syntax()
+        if stat.S_ISREG(file_stat.st_mode):
+            # Start at the current offset, in case that somebody already read from the file
+            self.position = os.lseek(fileno, 0, os.SEEK_CUR)
+            if file_stat.st_size == 0:
+                self.data = b""
+            else:
+                self.data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
 
-    def check_arg_syntax(self):
-        '''Performs syntax checking on symbols
+    def readline(self):
+        '''Reads the next line
 
-           Checks syntax of constant values and variable names. Variables are not checked on runtime.
+           @return Line without the newline character, empty string when the line isn't valid UTF-8, None at the end
+                   of input
         '''
+        data = self.data
+        if data is not None:
+            start = self.position
+            if start >= len(data):
+                return None
 
-        def check_var(var):
-            '''Helper for function check_arg_syntax - checks variable.
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = len(data)
+            self.position = end + 1
 
-               @returns true if values match types or value of incorrect operand.
-            '''
-            if re.fullmatch(r"(GF|TF|LF)@([a-zA-Z]|[_\-$&%*])[\w\-$&%*]*", var) is None:
-                print("interpret.py:", self.order, ": Variable/constant ", var, " has incorrect syntax.",
-                      file=sys.stderr, sep='')
-                sys.exit(32)
+            return self.decode(data[start:end])
 
-        def check_symb(symb):
-            '''Helper for function check_arg_syntax - checks symbols.
-               
-               @returns True if values match types or value of incorrect operand.
-            '''
-            # Can represent variable or constant
-            # Checking format of an immediate value - string, int, bool
+        while not self.lines:
+            if self.eof:
+                return None
+            self.read_chunk()
 
-            if re.fullmatch(r"([^#\\]|(\w))*", symb) is not None or \
-               re.fullmatch(r"[+-]?[0-9]+", symb) is not None or \
-               re.fullmatch(r"true|false", symb) is not None or \
-               re.fullmatch(r"nil", symb) is not None:
-                pass
-            else:
-                check_var(symb)
+        return self.decode(self.lines.pop())
 
-        def check_label(label):
-            '''Helper for function check_arg_syntax - checks label.
+    def read_chunk(self):
+        '''Reads a chunk of the stream and splits it into lines'''
+        stream = getattr(self.file, "buffer", self.file)
+        try:
+            chunk = stream.read1(self.chunk_size)
+        except AttributeError:
+            chunk = stream.read(self.chunk_size)
+
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+
+        if not chunk:
+            self.eof = True
+            if self.rest:
+                # Last line without a newline
+                self.lines.append(self.rest)
+                self.rest = b""
+            return
 
-               @returns true if values match types or value of incorrect operand.
-            '''
+        lines = (self.rest + chunk).split(b"\n")
+        self.rest = lines.pop()
+        lines.reverse()
+        self.lines = lines
 
-            if re.fullmatch(r"[_\-$&%*](\w|[\-$&%*])*", label) is None:
-                print("interpret.py:", self.order, ": Label ", label, " has incorrect syntax.",
-                      file=sys.stderr, sep='')
-                sys.exit(32)
+    @staticmethod
+    def decode(line):
+        '''Converts line from bytes
 
-        def check_type(v_type):
-            '''Helper for function check_arg_syntax - checks data type name.
+           @param line Bytes of the line
+           @return Decoded line, empty string (implicit value) when it's not valid UTF-8
+        '''
+        try:
+            return line.decode("utf-8")
+        except UnicodeDecodeError:
+            return ""
 
-               @returns True if values match types or value of incorrect operand.
-            '''
-            if v_type == "string" or v_type == "int" or v_type == "bool":
-                return True
-            else:
-                print("interpret.py:", self.order, ": Type ", type, " is not recognized.",
-                      file=sys.stderr, sep='')
-                sys.exit(32)
-
-        # Resolve which function to call based on expected_type
-        for arg, exp_type in itertools.zip_longest(self.argv, self.expected_arg_types):
-            if exp_type == "label":
-                return check_label(arg)
-            elif exp_type == "var":
-                return check_var(arg)
-            elif exp_type == "symb":
-                return check_symb(arg)
-            elif exp_type == "type":
-                return check_type(arg)
-
-    def read_var(self, program_instance, arg_idx, order):
-        '''Get value of a variable
+    def close(self):
+        '''Releases the memory mapping'''
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
 
-           Gets the value of a variable on runtime. Checks if it's defined otherwise raises an error.
-           @param program_instance Instance of a program (to access variables)
-           @param arg_idx Selects variable from given argument index (1-3)
-           @param order Order tag of invoking instruction (for error reporting)
-           @return Pythonic variable value
-        '''
-        retval = program_instance.frameset.get_var(self.argv[arg_idx], order)
-        if retval.type == "undefined":
-            print("interpret.py:", self.order, ": Variable", self.argv[arg_idx], "is undefined.",
-                  file=sys.stderr, sep='')
-            sys.exit(56)
 
-        retval = retval.value
+class OutputBuffer:
+    '''Buffered output stream
 
-        return retval
+       Collects text written by WRITE and DPRINT instructions and passes it to the underlying stream in large chunks,
+       so the interpreter doesn't make a write call for every instruction. Buffer is flushed when its size reaches the
+       threshold and by Program.execute when the program ends - normally, by EXIT or by an error. Line buffered mode
+       flushes after every newline and before READ waits for input, which is useful for interactive use.
+    '''
+    def __init__(self, stream, threshold=65536, line_buffered=False):
+        '''OutputBuffer constructor
 
-    def read_symb(self, program_instance, arg_idx, order):
-        '''Helper function that reads expected symbol argument
+           @param stream Text stream that receives the output
+           @param threshold Number of characters that triggers a flush, 0 disables buffering
+           @param line_buffered Flush after every newline
+        '''
+        self.stream = stream
+        self.threshold = threshold
+        self.line_buffered = line_buffered
+        self.parts = []
+        self.size = 0
 
-           @program_instance Instance of a program class - for getting variables
-           @arg_idx Index of the desired argument (1-3)
-           @return Value of a variable or a constant
+    def write(self, text):
+        '''Writes text to the buffer
+
+           @param text String to write
         '''
-        arg_idx = arg_idx - 1
-        retval = ""
-        if self.arg_types[arg_idx] == "var":
-            retval = self.read_var(program_instance, arg_idx, order)
-        elif self.arg_types[arg_idx] in self.accepted_const:
-            retval = self.argv[arg_idx]
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.threshold or (self.line_buffered and "\n" in text):
+            self.flush()
 
-            if self.arg_types[arg_idx] == "int":
-                retval = int(retval)
+    def flush(self):
+        '''Writes the buffered text to the underlying stream'''
+        if self.parts:
+            self.stream.write("".join(self.parts))
+            self.parts = []
+            self.size = 0
 
-            if self.arg_types[arg_idx] == "nil":
-                retval = None
+        self.stream.flush()
 
-            if self.arg_types[arg_idx] == "bool":
-                if retval == "true":
-                    retval = True
 
-                if retval == "false":
-                    retval = False
+class ProgramCache:
+    '''Cache of checked programs
 
-        return retval
+       Programs that passed all load-time checks are stored in a compact binary form (marshal), so repeated runs of
+       the same source skip XML parsing and syntax checking. Entries are files named by the SHA-256 hash of the source.
+       Every entry starts with a header, entries written by a different cache format, Python version, interpreter or
+       schema (IPPcode19.xsd) are ignored, so a change of the checks done before storing invalidates all entries.
+       Cache is only an optimization - entries that can't be read or written are silently skipped.
+    '''
+    format_version = 3  # Increase when the stored data change
+    checks_digest = None  # Hash of the files with the checks, computed once by get_checks_digest
 
-    def execute(self, program_instance):
-        """Interpretation caller
+    def __init__(self, directory):
+        '''ProgramCache constructor
 
-           This function calls instr_* functions that do the actual interpretation. Every instruction is independent,
-           so they can be executed separately.
+           @param directory Path to the directory with cache entries, it's created when needed
+        '''
+        self.directory = directory
+        self.header = "xIPP {} {} {}\n".format(self.format_version, marshal.version,
+                                               self.get_checks_digest()).encode("ascii")
 
-           @arg program_instance program instance is passed because some instructions change the control flow or modify
-                                 its member variables (e.g. frame stack)
-        """
-        eval("self.instr_" + self.name.lower() + "(program_instance)")
+    @classmethod
+    def get_checks_digest(cls):
+        '''Hashes the files that decide which programs pass the checks
 
-    # 0 ARGUMENTS
-    def instr_createframe(self, program_instance):
-        program_instance.frameset.init_temporary_frame()
+           @return Hexadecimal digest of interpret.py and IPPcode19.xsd (when it exists)
+        '''
+        if cls.checks_digest is None:
+            digest = hashlib.sha256()
+            directory = os.path.dirname(os.path.abspath(__file__))
+            for name in (os.path.basename(__file__), "IPPcode19.xsd"):
+                try:
+                    with open(os.path.join(directory, name), "rb") as checked_file:
+                        digest.update(checked_file.read())
+                except OSError:
+                    digest.update(b"-")
+            cls.checks_digest = digest.hexdigest()
 
-    def instr_pushframe(self, program_instance):
-        program_instance.frameset.push_temp(self.order)
+        return cls.checks_digest
 
-    def instr_popframe(self, program_instance):
-        program_instance.frameset.pop_local(self.order)
+    @staticmethod
+    def default_directory():
+        '''Default cache location
 
-    def instr_return(self, program_instance):
-        try:
-            jumpto = program_instance.callstack.pop()
-        except IndexError:
-            print("interpret.py:", self.order, ": Can't return, call stack is empty.",
-                  file=sys.stderr, sep='')
-            sys.exit(56)
-        program_instance.order_jumpto = jumpto
+           @return Directory xipp in XDG_CACHE_HOME (~/.cache when not set)
+        '''
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "xipp")
 
-    def instr_break(self, program_instance):
-        print("Code position (from order attribute):", self.order, file=sys.stderr)
-        print("GLOBAL FRAME:", file=sys.stderr)
-        for name, value in program_instance.frameset.global_frame.vars.items():
-            print("GF@", name, ": ", value, file=sys.stderr, sep='')
-        print(file=sys.stderr)
-        print("TEMPORARY FRAME:", file=sys.stderr)
-        if program_instance.frameset.temporary_frame is None:
-            print("Undefined", file=sys.stderr)
-        else:
-            for name, value in program_instance.frameset.global_frame.vars.items():
-                print("TF@", name, ": ", value, file=sys.stderr, sep='')
-        print(file=sys.stderr)
+    @staticmethod
+    def hash_source(source_file):
+        '''Hashes the source code
 
-        frames_under = len(program_instance.frameset.local_frame_stack) - 1
-        print("LOCAL FRAME:", file=sys.stderr)
-        if frames_under < 0:
-            print("Undefined", file=sys.stderr)
+           Reads the whole source file. Seekable files are rewound, so they can be parsed again. Other streams are kept
+           in memory.
+           @param source_file Binary file object with the XML representation of the program
+           @return Tuple of hexadecimal digest and a file object positioned at the start of the source
+        '''
+        digest = hashlib.sha256()
+        chunks = []
+        try:
+            seekable = source_file.seekable()
+            start = source_file.tell() if seekable else 0
+        except (AttributeError, OSError):
+            seekable = False
+
+        for chunk in iter(lambda: source_file.read(1 << 20), b""):
+            digest.update(chunk)
+            if not seekable:
+                chunks.append(chunk)
+
+        if seekable:
+            source_file.seek(start)
         else:
-            print("Top frame (on top of", frames_under, "frames):", file=sys.stderr)
-            local_frame = program_instance.frameset.local_frame_stack[-1]
-            for name, value in local_frame.items():
-                print("TF@", name, ": ", value, file=sys.stderr, sep='')
+            source_file = io.BytesIO(b"".join(chunks))
 
-    # 1 ARGUMENT
-    def instr_defvar(self, program_instance):
-        try:
-            program_instance.frameset.set_var(self.argv[0])
-        except KeyError:
-            print("interpret.py:", self.order, ": Label ", self.argv[0], " doesn't exist.",
-                  file=sys.stderr, sep='')
-            sys.exit(52)
+        return (digest.hexdigest(), source_file)
 
-    def instr_call(self, program_instance):
-        program_instance.callstack.append(program_instance.order_next)
-        try:
-            jumpto = program_instance.labels[self.argv[0]]
-        except KeyError:
-            print("interpret.py:", self.order, ": Label ", self.argv[0], " doesn't exist.",
-                  file=sys.stderr, sep='')
-            sys.exit(52)
-        program_instance.order_jumpto = jumpto
+    def path(self, digest):
+        '''Path of a cache entry
 
-    def instr_pushs(self, program_instance):
-        # UNSUPPORTED
-        pass
+           @param digest Hash of the source code
+           @return Path to the file with the entry
+        '''
+        return os.path.join(self.directory, digest + ".ippc")
 
-    def instr_pops(self, program_instance):
-        # UNSUPPORTED
-        pass
+    def load(self, digest):
+        '''Reads a cached program
 
-    def instr_write(self, program_instance):
-        retval = self.read_symb(program_instance, 1, self.order)
+           @param digest Hash of the source code
+           @return Serialized program (see Program.serialize), None when there is no usable entry
+        '''
+        try:
+            with open(self.path(digest), "rb") as cache_file:
+                if cache_file.readline() != self.header:
+                    return None
+                return marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, digest, records):
+        '''Writes a program to the cache
+
+           Entry is written to a temporary file that is renamed, so concurrent runs never read a partial entry.
+           @param digest Hash of the source code
+           @param records Serialized program (see Program.serialize)
+        '''
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            (handle, temp_path) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(handle, "wb") as cache_file:
+                    cache_file.write(self.header)
+                    marshal.dump(records, cache_file)
+                os.replace(temp_path, self.path(digest))
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        except (OSError, ValueError):
+            pass
+
+    def invalidate(self, digest):
+        '''Removes a cached program
+
+           @param digest Hash of the source code
+        '''
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
 
-        if retval is True:
-            retval = "true"
+
+class Profiler:
+    '''Execution profiler
+
+       Runs the program in its own loop that measures every executed instruction, so the main loop in
+       Program.execute stays as fast as without profiling. Counts and times are kept per index in the instruction
+       array and summed by order, opcode and block (instructions from a LABEL up to the next LABEL) when the report
+       is written. CALL and RETURN are tracked on a shadow call stack that gives inclusive times of called labels and
+       the stacks for flame graphs.
+    '''
+    def __init__(self):
+        '''Profiler constructor
+
+           Creates a profiler without any data. It's filled by execute.
+        '''
+        self.program = []       # Profiled instruction array
+        self.counts = []        # Number of executions of every instruction, indices match the instruction array
+        self.times = []         # Time spent in every instruction in seconds
+        self.calls = {}         # Keys are called labels, values are lists [number of calls, inclusive time]
+        self.stacks = {}        # Keys are tuples (labels on the call stack, opcode), values are times in seconds
+        self.total = 0.0        # Wall time of the execution
+
+    def execute(self, program_instance):
+        '''Profiling interpreter loop
+
+           Does the same as Program.execute and measures every instruction. The instruction that ends the program by
+           an exception (EXIT or an error) is measured too.
+           @param program_instance Instance of Program
+           @throws InterpretError When an instruction fails
+           @throws ProgramExit When instruction EXIT is executed
+        '''
+        program = program_instance.program
+        end = len(program)
+        self.program = program
+        self.counts = counts = [0] * end
+        self.times = times = [0.0] * end
+        # 1 for CALL, 2 for RETURN, 0 for other instructions
+        kinds = [{"CALL": 1, "RETURN": 2}.get(instruction.name, 0) for instruction in program]
+        opcodes = [instruction.name for instruction in program]
+        block_sizes = program_instance.block_sizes
+        calls = self.calls
+        stacks = self.stacks
+        call_stack = []         # Tuples (called label, start time)
+        path = ()               # Labels on call_stack, the stack key of executed instructions
+        clock = time.perf_counter
+
+        pc = 0
+        executed = 0            # Dispatches, fused instructions are added from program_instance.fused
+        started = start = clock()
+        program_instance.pc = 0
+        try:
+            while program_instance.pc < end:
+                pc = program_instance.pc
+                instruction = program[pc]
+                program_instance.pc = pc + 1
+                program_instance.countdown -= block_sizes[pc]
+                if program_instance.countdown < 0:
+                    program_instance.check_limits()
+                executed += 1
+
+                start = clock()
+                instruction.handler(program_instance)
+                elapsed = clock() - start
+                counts[pc] += 1
+                times[pc] += elapsed
+                key = (path, opcodes[pc])
+                stacks[key] = stacks.get(key, 0.0) + elapsed
+
+                kind = kinds[pc]
+                if kind == 1:
+                    call_stack.append((instruction.operands[0], start))
+                    path = path + (instruction.operands[0],)
+                elif kind == 2 and call_stack:
+                    self.add_call(*call_stack.pop(), clock())
+                    path = path[:-1]
+            pc = None
+        finally:
+            stopped = clock()
+            program_instance.executed = executed + program_instance.fused
+            if pc is not None:
+                # Instruction ended the program by an exception
+                counts[pc] += 1
+                times[pc] += stopped - start
+                key = (path, opcodes[pc])
+                stacks[key] = stacks.get(key, 0.0) + stopped - start
+
+            # Calls that didn't return last until the end of the program
+            while call_stack:
+                self.add_call(*call_stack.pop(), stopped)
+            self.total = stopped - started
+
+    def add_call(self, label, start, stop):
+        '''Records a finished call
+
+           @param label Called label
+           @param start Time when CALL was executed
+           @param stop Time when the call returned
+        '''
+        record = self.calls.setdefault(label, [0, 0.0])
+        record[0] += 1
+        record[1] += stop - start
+
+    def summary(self):
+        '''Sums the measured data
+
+           @return Dictionary with lists of instructions, opcodes, blocks and calls sorted by time (descending)
+        '''
+        instructions = []
+        opcodes = {}
+        blocks = {}
+        block = "<start>"   # Instructions before the first label
+        for (idx, instruction) in enumerate(self.program):
+            if instruction.name == "LABEL":
+                block = instruction.operands[0]
+            if self.counts[idx] == 0:
+                continue
+
+            (count, spent) = (self.counts[idx], self.times[idx])
+            instructions.append({"order": instruction.order, "opcode": instruction.name, "count": count,
+                                 "time": spent})
+            for (key, table) in ((instruction.name, opcodes), (block, blocks)):
+                record = table.setdefault(key, [0, 0.0])
+                record[0] += count
+                record[1] += spent
+
+        def by_time(records):
+            return sorted(records, key=lambda record: record["time"], reverse=True)
+
+        return {"total_time": self.total,
+                "total_count": sum(self.counts),
+                "instructions": by_time(instructions),
+                "opcodes": by_time({"opcode": key, "count": count, "time": spent}
+                                   for (key, (count, spent)) in opcodes.items()),
+                "blocks": by_time({"label": key, "count": count, "time": spent}
+                                  for (key, (count, spent)) in blocks.items()),
+                "calls": by_time({"label": key, "count": count, "time": spent}
+                                 for (key, (count, spent)) in self.calls.items())}
+
+    def write(self, path):
+        '''Writes the profile
+
+           Sorted report is written to the given file, the same data as JSON to the file with suffix .json and the
+           stacks in collapsed format (for flamegraph.pl and similar tools) to the file with suffix .folded.
+           @param path Path of the report
+           @throws OSError When a file can't be written
+        '''
+        summary = self.summary()
+        total = summary["total_time"] or 1.0
+
+        with open(path, "w") as report:
+            print("Executed {} instructions in {:.6f} s".format(summary["total_count"], summary["total_time"]),
+                  file=report)
+            for (title, section, key) in (("Opcodes", "opcodes", "opcode"), ("Blocks", "blocks", "label"),
+                                          ("Calls (inclusive time)", "calls", "label"),
+                                          ("Instructions", "instructions", "order")):
+                print(file=report)
+                print(title, file=report)
+                print("{:>12} {:>12} {:>7}  {}".format("count", "time [s]", "time %", key), file=report)
+                for record in summary[section]:
+                    name = record[key]
+                    if section == "instructions":
+                        name = "{} {}".format(name, record["opcode"])
+                    print("{:>12} {:>12.6f} {:>6.2f}%  {}".format(record["count"], record["time"],
+                                                                  record["time"] / total * 100, name), file=report)
+
+        with open(path + ".json", "w") as report:
+            json.dump(summary, report, indent=2)
+
+        with open(path + ".folded", "w") as report:
+            for ((labels, opcode), spent) in sorted(self.stacks.items()):
+                # Values are integers, so times are in microseconds
+                print("{} {}".format(";".join(("main",) + labels + (opcode,)), round(spent * 1e6)), file=report)
+
+
+class Schema:
+    '''Rules of the XML representation of programs
+
+       Structure rules are derived from IPPcode19.xsd - allowed and required attributes of the program and instruction
+       elements, the lowest order value, names of argument elements and their types. Built-in rules are the same as in
+       the schema and they are used when the file isn't next to the interpreter. Values of arguments are checked by
+       lexical patterns of IPPcode19 (the same as in parse.php), the schema declares them only as strings.
+
+       An instruction element is checked in one pass over its attributes and children. Patterns are compiled once,
+       when the class is defined.
+    '''
+    namespace = "{http://www.w3.org/2001/XMLSchema}"
+    instance = None  # Schema shared by all programs (created by get)
+
+    # Lexical patterns of argument values by the type attribute, applied before escape sequences are decoded
+    identifier = r"[A-Za-z_\-$&%*!?][A-Za-z0-9_\-$&%*!?]*"
+    patterns = {
+        "var": re.compile(r"(?:GF|LF|TF)@" + identifier),
+        "label": re.compile(identifier),
+        "int": re.compile(r"[+-]?[0-9]+"),
+        "bool": re.compile(r"true|false"),
+        "nil": re.compile(r"nil"),
+        "string": re.compile(r"(?:[^\s#\\]|\\[0-9]{3})*"),
+        "type": re.compile(r"int|string|bool"),
+    }
+    # Error messages of values that don't match the pattern
+    messages = {"label": "Label {} has incorrect syntax.", "type": "Type {} is not recognized."}
+    # Argument types accepted where an instruction expects a symbol
+    symbol_types = {"var", "int", "bool", "string", "nil"}
+
+    def __init__(self, schema_file=None):
+        '''Schema constructor
+
+           @param schema_file Path to IPPcode19.xsd, None for built-in rules
+           @throws OSError When the file can't be read
+           @throws xml.etree.ElementTree.ParseError When the file isn't valid XML
+        '''
+        # Attribute names mapped to True when the attribute is required
+        self.program_attributes = {"language": True, "name": False, "description": False}
+        self.instruction_attributes = {"order": True, "opcode": True}
+        self.order_minimum = 1
+        # Argument element names mapped to accepted values of their type attribute, in the order of arguments
+        arg_types = {"int", "bool", "string", "nil", "label", "type", "var"}
+        self.argument_types = {"arg1": arg_types, "arg2": arg_types, "arg3": arg_types}
+
+        if schema_file is not None:
+            self.derive(xml_et.parse(schema_file).getroot())
+
+        self.argument_positions = {tag: position for (position, tag) in enumerate(self.argument_types)}
+
+    @classmethod
+    def get(cls):
+        '''Returns the shared schema
+
+           The schema is read from IPPcode19.xsd next to the interpreter when it's needed for the first time.
+           @return Instance of Schema
+        '''
+        if cls.instance is None:
+            try:
+                cls.instance = cls(os.path.join(os.path.dirname(os.path.abspath(__file__)), "IPPcode19.xsd"))
+            except (OSError, xml_et.ParseError):
+                cls.instance = cls()
+
+        return cls.instance
+
+    def derive(self, root):
+        '''Reads rules from the schema
+
+           @param root Root element of the XSD
+        '''
+        ns = self.namespace
+        argument_types = {}
+        for element in root.iter(ns + "element"):
+            name = element.get("name")
+            attributes = {attribute.get("name"): attribute.get("use") == "required"
+                          for attribute in element.findall(ns + "attribute")}
+            if name == "program":
+                self.program_attributes = attributes
+            elif name == "instruction":
+                self.instruction_attributes = attributes
+                minimum = element.find("{0}attribute[@name='order']//{0}minInclusive".format(ns))
+                if minimum is not None:
+                    self.order_minimum = int(minimum.get("value"))
+            elif "type" in attributes:
+                # Argument element - values of its type attribute are enumerated
+                argument_types[name] = {value.get("value") for value in element.iter(ns + "enumeration")}
+
+        if argument_types:
+            self.argument_types = argument_types
+
+    def check_program(self, elem_program):
+        '''Root element checker
+
+           Checks the name and attributes of the program element.
+           @param elem_program Element program from ElementTree
+        '''
+        if elem_program.tag != "program":
+            raise XMLStructureError("Root element must be program.")
+
+        attributes = elem_program.attrib
+        for name in attributes:
+            if name not in self.program_attributes:
+                raise XMLStructureError("Invalid attribute in the program element.")
+        for (name, required) in self.program_attributes.items():
+            if required and name not in attributes:
+                raise XMLStructureError("Program element is missing a {} attribute.".format(name))
+
+        if attributes.get("language", "ippcode19").lower() != "ippcode19":
+            raise XMLStructureError("Program element contains an incorrect language attribute.")
+
+    def check_instruction(self, idx, element):
+        '''Instruction element checker
+
+           Checks the element, its attributes, arguments and their values. Escape sequences in strings are decoded.
+           @param idx Position of the element in the document (for error reporting when order is unknown)
+           @param element Instruction element from ElementTree
+           @return Tuple of the order, the opcode in upper case, list of argument texts and list of argument types
+        '''
+        if element.tag != "instruction":
+            raise XMLStructureError("Invalid child element in the program element.")
+
+        attributes = element.attrib
+        for name in attributes:
+            if name not in self.instruction_attributes:
+                raise XMLStructureError("Invalid attribute in the instruction element.", idx)
+
+        order = attributes.get("order")
+        if order is None:
+            raise XMLStructureError("Undefined order attribute. (Order of element in document is provided here)",
+                                    idx)
+        # int() alone would accept whitespace and underscores, xs:integer doesn't
+        order = int(order) if self.patterns["int"].fullmatch(order) is not None else None
+        if order is None or order < self.order_minimum:
+            raise XMLStructureError("Order attribute contains an invalid value. (Order of element in document is "
+                                    "provided here)", idx)
+
+        opcode = attributes.get("opcode")
+        if opcode is None:
+            raise XMLStructureError("Undefined opcode attribute in instruction {}.".format(order), order)
+        opcode = opcode.upper()
+        try:
+            expected_types = Instruction.param_types[opcode]
+        except KeyError:
+            raise XMLStructureError("Unknown instruction name.", order)
+        if element.text is not None and not element.text.isspace():
+            raise XMLStructureError("Instruction element contains text.", order)
+
+        # Argument elements by their position
+        positions = self.argument_positions
+        arguments = [None] * len(positions)
+        for argument in element:
+            position = positions.get(argument.tag)
+            if position is None or arguments[position] is not None:
+                raise XMLStructureError("Too many, duplicate arguments or unrecognized child elements.", order)
+            if "type" not in argument.attrib:
+                raise XMLStructureError("Attribute type is missing.", order)
+            if len(argument.attrib) > 1 or len(argument) or (argument.tail is not None and not argument.tail.isspace()):
+                raise XMLStructureError("Argument {} contains invalid content.".format(position + 1), order)
+            arguments[position] = argument
+
+        # Arguments are numbered from 1 without gaps, missing and extra arguments have an incorrect type
+        count = len(expected_types)
+        for position in range(count, len(arguments)):
+            if arguments[position] is not None:
+                raise XMLStructureError("Argument {} in instruction has incorrect type.".format(position + 1), order)
+
+        argv = []
+        arg_types = []
+        for position in range(count):
+            argument = arguments[position]
+            if argument is None:
+                raise XMLStructureError("Argument {} in instruction has incorrect type.".format(position + 1), order)
+            arg_type = argument.attrib["type"]
+            expected = expected_types[position]
+            if (arg_type != expected and (expected != "symb" or arg_type not in self.symbol_types)) or \
+                    arg_type not in self.argument_types[argument.tag]:
+                raise XMLStructureError("Argument {} in instruction has incorrect type.".format(position + 1), order)
+
+            text = argument.text or ""
+            if self.patterns[arg_type].fullmatch(text) is None:
+                raise XMLStructureError(self.messages.get(arg_type, "Variable/constant {} has incorrect syntax.")
+                                        .format(text), order)
+            if arg_type == "string":
+                # Equal literals share one object
+                text = sys.intern(decode_escapes(text))
+            argv.append(text)
+            arg_types.append(arg_type)
+
+        return (order, opcode, argv, arg_types)
+
+
+class Program:
+    '''Program class
+
+       Program class holds instructions parsed from the xml. Before execution, they are compiled into a dense array
+       ordered by their order attributes. To handle jumps, it contains dictionary of labels - keys are labels and
+       values are indices to the instruction array. Method execute is used as main loop of the interpreter, so
+       frameset and subsequently frames and variables are stored here for easy access. Member variable pc is the
+       program counter - index of the next instruction to execute. Instructions that change control flow overwrite it.
+    '''
+    def __init__(self, output_stream=None, error_stream=None):
+        '''Program constructor
+
+           Creates a new program instance. Instructions are loaded by method load.
+           @param output_stream Text stream for WRITE (standard output by default)
+           @param error_stream Text stream for DPRINT and BREAK (standard error output by default)
+        '''
+        self.output_stream = output_stream if output_stream is not None else sys.stdout
+        self.error_stream = error_stream if error_stream is not None else sys.stderr
+        self.instructions = {}          # Dictionary of instructions - keys are their order values (iterate sorted)
+        self.program = []               # Instructions compiled into an array sorted by their order values
+        self.handlers = []              # Handlers executed by the main loop, indices match the instruction array
+        self.block_sizes = []           # Numbers of instructions of blocks at indices where they start, 0 elsewhere
+        self.tier_threshold = BlockCompiler.threshold  # Entries of a basic block before it's compiled, 0 never
+        self.labels = {}                # Index names are labels and keys are indices to the instruction array
+        self.name = None                # DEPRECATED: Value of attribute name in element program
+        self.description = None         # DEPRECATED: Value of attribute description in element program
+        self.frameset = FrameSet()      # Frameset instance taht contains frames and variables
+        self.callstack = []             # List of return indices from call instructions to return instructions
+        self.data_stack = []            # Values pushed by PUSHS and stack instructions, top is the last item
+        self.pc = 0                     # Program counter - index of the next instruction in the instruction array
+        self.stdin_file = None          # A file object that contains a file when --input argument was given
+        self.input = None               # InputReader of inputs for READ instructions (stdin when not set)
+        self.profiler = None            # Profiler that executes the program instead of the main loop (--profile)
+        self.count_instructions = False  # Count executed instructions (--insts)
+        self.executed = 0               # Number of executed instructions, counted only when count_instructions is set
+        self.fused = 0                  # Instructions executed by fused handlers without a dispatch of their own
+        self.limits = None              # Limits of the run, None when nothing is limited
+        self.countdown = sys.maxsize    # Instructions until the next check of limits, decreased by every block
+        self.charged = sys.maxsize      # Value of countdown after the last check
+        self.instructions_left = None   # Instructions the program can still execute, None when unlimited
+        self.deadline = None            # Time (time.monotonic) when the program must end, None when unlimited
+        self.max_calls = sys.maxsize    # Maximum depth of the call stack
+        self.max_string = sys.maxsize   # Maximum length of strings built by CONCAT
+        self.output = OutputBuffer(self.output_stream)       # Buffered standard output for WRITE
+        self.debug_output = OutputBuffer(self.error_stream)  # Buffered standard error output for DPRINT and BREAK
+
+    def copy(self, output_stream=None, error_stream=None):
+        '''Copy of a compiled program for another run
+
+           Instructions aren't changed by execution, so the copy shares them with this program. Frames, call stack,
+           program counter, input and output of the copy are new.
+           @param output_stream Text stream for WRITE (standard output by default)
+           @param error_stream Text stream for DPRINT and BREAK (standard error output by default)
+           @return New instance of Program ready for execute
+        '''
+        program = Program(output_stream, error_stream)
+        program.instructions = self.instructions
+        program.program = self.program
+        program.handlers = self.handlers
+        program.block_sizes = self.block_sizes
+        program.tier_threshold = self.tier_threshold
+        program.labels = self.labels
+        program.name = self.name
+        program.description = self.description
+        program.frameset = FrameSet(self.frameset.global_names, self.frameset.local_names)
+
+        return program
+
+    def set_input(self, stdin_file):
+        '''Input file
+
+           Saves a file object with inputs for READ instructions so it can be easily accessed and creates a buffered
+           reader for it.
+           @param stdin_file A file object with inputs for READ instruction
+        '''
+        if self.input is not None:
+            self.input.close()
+        self.stdin_file = stdin_file
+        self.input = InputReader(stdin_file)
+
+    def set_output(self, threshold, line_buffered):
+        '''Output buffering
+
+           Configures buffers of the standard output and the standard error output.
+           @param threshold Number of buffered characters that triggers a flush, 0 disables buffering
+           @param line_buffered Flush after every newline and before reading from standard input
+        '''
+        self.flush()
+        self.output = OutputBuffer(self.output_stream, threshold, line_buffered)
+        self.debug_output = OutputBuffer(self.error_stream, threshold, line_buffered)
+
+    def flush(self):
+        '''Flushes buffered output
+
+           Called at the end of the execution, including EXIT and errors.
+        '''
+        self.output.flush()
+        self.debug_output.flush()
+
+    def close(self):
+        '''Releases the input reader'''
+        if self.input is not None:
+            self.input.close()
+
+    def extract_instructions(self, source_file):
+        '''XML parser and checker
+
+           This method reads the XML and checks that is syntactically correct. This implementation supports
+           instructions out-of-order and with non-following order attributes. XML should strictly follow the specifi-
+           cation, invalid values and unsupported elements raise an error. XML comments are allowed.
+
+           The XML is read by an incremental parser. Every instruction element is checked and turned into an instance
+           of Instruction as soon as its end tag is read and then it's removed from the tree. Memory usage depends on
+           the number of instructions, not on the size of the XML document.
+
+           Garbage collection is paused while the XML is read. Instructions live as long as the program, so collections
+           triggered by creating them would only walk all instructions created so far again and again.
+           @param source_file Binary file object with the XML representation of the program
+        '''
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.parse_instructions(source_file)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def parse_instructions(self, source_file):
+        '''Reads instruction elements
+
+           @param source_file Binary file object with the XML representation of the program
+        '''
+        events = xml_et.iterparse(source_file, events=("start", "end"))
+        try:
+            # Root element is checked when its start tag is read - attributes are already known
+            (_, elem_program) = next(events)
+            try:
+                self.check_program(elem_program)
+            except InterpretError:
+                # Malformed XML after the root start tag still takes precedence
+                for _ in events:
+                    pass
+                raise
+
+            # Depth of the current element - instructions end in depth 0, root element in depth -1
+            depth = 0
+            idx = 0
+            for (event, element) in events:
+                if event == "start":
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth == 0:
+                    idx += 1
+                    try:
+                        self.add_instruction(idx, element)
+                    except InterpretError:
+                        # Malformed XML takes precedence over errors in instructions
+                        for _ in events:
+                            pass
+                        raise
+                    # Drop the processed instruction from the tree
+                    elem_program.clear()
+        except xml_et.ParseError:
+            raise XMLFormatError("Malformed XML.")
+        except StopIteration:
+            # No start tag in the whole document
+            raise XMLFormatError("Malformed XML.")
+
+    def load(self, source_file, cache=None, invalidate=False):
+        '''Loads the program
+
+           Takes the program from the cache when it contains an entry for this source, otherwise the XML is parsed and
+           checked by extract_instructions and the result is stored in the cache.
+           @param source_file Binary file object with the XML representation of the program
+           @param cache Instance of ProgramCache, None disables caching
+           @param invalidate Ignore and replace the cached entry for this source
+        '''
+        if cache is None:
+            self.extract_instructions(source_file)
+            return
+
+        (digest, source_file) = cache.hash_source(source_file)
+        if invalidate:
+            cache.invalidate(digest)
+        else:
+            records = cache.load(digest)
+            if records is not None:
+                self.deserialize(records)
+                return
+
+        self.extract_instructions(source_file)
+        cache.store(digest, self.serialize())
+
+    def serialize(self):
+        '''Converts checked instructions to basic types
+
+           @return Tuple of instruction records (order, opcode, argument texts, argument types) that can be stored by
+                   marshal
+        '''
+        return tuple((instruction.order, instruction.name, tuple(instruction.argv), tuple(instruction.arg_types))
+                     for instruction in self.instructions.values())
+
+    def deserialize(self, records):
+        '''Creates instructions from records made by serialize
+
+           Records were checked before they were serialized, so the checks are skipped.
+           @param records Tuple of instruction records
+        '''
+        for (order, opcode, argv, arg_types) in records:
+            # Pad arguments to three
+            args = list(argv) + [None] * (3 - len(argv))
+            types = list(arg_types) + [None] * (3 - len(arg_types))
+            self.instructions[order] = Instruction(order, opcode, *args, *types)
+
+    def check_program(self, elem_program):
+        '''Root element checker
+
+           @param elem_program Element program from ElementTree
+        '''
+        Schema.get().check_program(elem_program)
+
+    def add_instruction(self, idx, instruction):
+        '''Instruction element checker
+
+           Checks an instruction element and its arguments and creates an instance of Instruction from it.
+           @param idx Position of the element in the document (for error reporting when order is unknown)
+           @param instruction Instruction element from ElementTree
+        '''
+        (order, opcode, argv, arg_types) = Schema.get().check_instruction(idx, instruction)
+        if order in self.instructions:
+            raise XMLStructureError("Duplicate order attribute.", order)
+
+        # Pad arguments to three
+        args = argv + [None] * (3 - len(argv))
+        types = arg_types + [None] * (3 - len(arg_types))
+        self.instructions[order] = Instruction(order, opcode, *args, *types)
+
+    def compile(self):
+        '''Instruction array builder
+
+           Turns the sparse dictionary of instructions into a dense array sorted by order values. Labels are resolved
+           to array indices and every jump instruction gets its target index precomputed, so the main loop only moves
+           the program counter and never searches for the next instruction. Undefined labels are left unresolved and
+           reported when the jump is executed. Variables defined by DEFVAR get slot numbers in frames.
+        '''
+        self.program = [self.instructions[order] for order in sorted(self.instructions)]
+        self.link()
+
+        # Assign frame slots to variables defined by DEFVAR - temporary frame becomes local, so they share slots
+        global_names = {}
+        local_names = {}
+        for instruction in self.program:
+            if instruction.name == "DEFVAR":
+                ref = instruction.operands[0]
+                names = global_names if ref.scope == "GF" else local_names
+                names.setdefault(ref.identifier, len(names))
+
+        for instruction in self.program:
+            for operand in instruction.operands:
+                if isinstance(operand, VarRef):
+                    names = global_names if operand.scope == "GF" else local_names
+                    operand.slot = names.get(operand.identifier)
+
+        # Dictionaries keep insertion order, so identifiers are listed by their slot numbers
+        self.frameset = FrameSet(global_names, local_names)
+
+    def link(self):
+        '''Label resolver
+
+           Builds the label dictionary from the instruction array and precomputes target indices of jump instructions.
+           Types of operands are inferred before handlers are chosen. Called by compile and again by Optimizer after it
+           changes the array.
+        '''
+        # Build label dictionary
+        self.labels = {}
+        for (idx, instruction) in enumerate(self.program):
+            if instruction.name == "LABEL":
+                self.labels[instruction.operands[0]] = idx
+
+        # Resolve jump targets
+        for instruction in self.program:
+            if instruction.name in Instruction.jump_opcodes:
+                instruction.target = self.labels.get(instruction.operands[0])
+
+        TypeInference().infer(self.program)
+        self.specialize()
+        self.split_blocks()
+
+    def specialize(self):
+        '''Hot pattern recognizer
+
+           Replaces handlers of instructions that start common loop patterns by fused handlers. Comparison followed by
+           a conditional jump on its result compares and branches in one step, adding a constant to a variable changes
+           the variable in place and concatenation onto the same variable appends in place. PUSHS of a constant pushes
+           the value without reading the operand. Other instructions with operand types proven by TypeInference get
+           handlers without type checks. Instructions stay where they are, the fused comparison skips the jump by moving
+           the program counter.
+        '''
+        program = self.program
+        for (idx, instruction) in enumerate(program):
+            if not isinstance(instruction, Instruction):
+                # Superinstructions keep handlers of their parts
+                continue
+
+            instruction.handler = MethodType(Instruction.handlers[instruction.name], instruction)
+            if idx + 1 < len(program) and instruction.fuse_compare_branch(program[idx + 1]):
+                instruction.handler = instruction.fused_compare_branch
+            elif instruction.fuse_increment():
+                instruction.handler = instruction.fused_increment
+            elif instruction.fuse_append():
+                instruction.handler = instruction.fused_append
+            elif instruction.name == "PUSHS" and isinstance(instruction.operands[0], Constant):
+                instruction.handler = instruction.fused_push_constant
+            elif instruction.typed and instruction.name == "IDIV":
+                instruction.handler = instruction.typed_idiv
+            elif instruction.typed and instruction.name == "CONCAT":
+                instruction.handler = instruction.typed_concat
+            elif instruction.typed and instruction.name in Instruction.typed_operations:
+                instruction.operation = Instruction.typed_operations[instruction.name]
+                instruction.handler = instruction.typed_binary
+
+    def split_blocks(self):
+        '''Basic block splitter
+
+           Builds the handler array of the main loop from handlers of the instructions. Handler of the first
+           instruction of every basic block is replaced by Block.enter, which charges the block to the limits of the
+           run and compiles the block when it gets hot (never when tier_threshold is 0). Blocks start at the first
+           instruction, at labels and after jumps, calls, returns and exits.
+        '''
+        program = self.program
+        self.handlers = handlers = [instruction.handler for instruction in program]
+        self.block_sizes = [0] * len(program)
+        if not program:
+            return
+
+        leaders = {0}
+        for (idx, instruction) in enumerate(program):
+            if instruction.name == "LABEL":
+                leaders.add(idx)
+            elif instruction.name in Optimizer.control_opcodes and idx + 1 < len(program):
+                leaders.add(idx + 1)
+
+        starts = sorted(leaders)
+        for (start, end) in zip(starts, starts[1:] + [len(program)]):
+            block = Block(program, handlers, start, end, self.tier_threshold)
+            handlers[start] = block.enter
+            self.block_sizes[start] = block.size
+
+    def dump(self, dump_file):
+        '''Writes the compiled program
+
+           Every line contains the order and the instruction in IPPcode19 syntax. Superinstructions are written as
+           their parts separated by semicolons. Used to check what Optimizer did.
+           @param dump_file Text file object
+        '''
+        for instruction in self.program:
+            print("{:>8}  {}".format(instruction.order, instruction.text()), file=dump_file)
+
+    def start_limits(self):
+        '''Prepares limits of the run
+
+           Copies the limits to the counters checked during the execution. The time limit starts now.
+        '''
+        limits = self.limits if self.limits is not None else Limits()
+        self.instructions_left = limits.instructions
+        self.deadline = None if limits.time is None else time.monotonic() + limits.time
+        self.max_calls = sys.maxsize if limits.calls is None else limits.calls
+        self.max_string = sys.maxsize if limits.string is None else limits.string
+        self.frameset.max_frames = sys.maxsize if limits.frames is None else limits.frames
+        self.refill()
+
+    def refill(self):
+        '''Sets the countdown to the next check of limits
+
+           The instruction limit is checked when exactly the remaining instructions are used up, the time limit after
+           every Limits.check_interval instructions.
+        '''
+        countdown = sys.maxsize if self.deadline is None else Limits.check_interval
+        if self.instructions_left is not None:
+            countdown = min(countdown, self.instructions_left)
+        self.countdown = self.charged = countdown
+
+    def check_limits(self):
+        '''Checks the instruction and time limits
+
+           Called when the countdown drops below zero. Blocks decrease the countdown by their number of instructions
+           before they are executed, so the instruction limit stops the program before the block that would exceed it.
+           @throws InstructionLimitError When the program would execute more instructions than allowed
+           @throws TimeLimitError When the program runs longer than allowed
+        '''
+        if self.instructions_left is not None:
+            self.instructions_left -= self.charged - self.countdown
+            if self.instructions_left < 0:
+                raise InstructionLimitError("Program exceeded the limit of {} instructions.".format(
+                    self.limits.instructions))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeLimitError("Program exceeded the time limit of {} s.".format(self.limits.time))
+
+        self.refill()
+
+    def execute(self):
+        '''Main interpreter loop
+
+           This method implements executing the instructions in the interpreter. Instructions are taken from the array
+           created by method compile. The program counter is moved before the instruction is executed, so jumps and
+           calls can overwrite it and call instructions can save it as the return index. The main loop executes
+           handlers from the handler array, where hot basic blocks are replaced by their compiled functions that
+           execute the whole block and set the program counter themselves. Profiling and counting of instructions run
+           every instruction by its own handler and charge the limits by block_sizes. Buffered output is flushed
+           however the program ends - EXIT and errors leave the loop with an exception.
+           @throws InterpretError When an instruction fails or a limit is exceeded
+           @throws ProgramExit When instruction EXIT is executed
+        '''
+        program = self.program
+        end = len(program)
+        self.pc = 0
+        self.start_limits()
+
+        try:
+            if self.profiler is not None:
+                self.profiler.execute(self)
+                return
+
+            if self.count_instructions:
+                # The same loop with a counter, so the main loop isn't slowed down when statistics are off
+                executed = 0
+                block_sizes = self.block_sizes
+                try:
+                    while self.pc < end:
+                        instruction = program[self.pc]
+                        self.countdown -= block_sizes[self.pc]
+                        if self.countdown < 0:
+                            self.check_limits()
+                        self.pc += 1
+                        executed += 1
+                        instruction.handler(self)
+                finally:
+                    self.executed = executed + self.fused
+                return
+
+            handlers = self.handlers
+            while self.pc < end:
+                pc = self.pc
+                self.pc = pc + 1
+
+                # Passing program instance because instructions need to change frames, variables, etc.
+                handlers[pc](self)
+        finally:
+            self.flush()
+
+
+class Instruction:
+    """Instruction representation
+
+       Implements the instruction syntax checking and the actual implementation of every instruction in methods instr_*.
+    """
+
+    accepted_const = {"int", "bool", "string", "nil"}  # Strings that are accepted as type
+    compare_opcodes = {"LT", "GT", "EQ"}  # Comparisons that can be fused with a following conditional jump
+    # Instructions with a label that is resolved to an index
+    jump_opcodes = {"CALL", "JUMP", "JUMPIFEQ", "JUMPIFNEQ", "JUMPIFEQS", "JUMPIFNEQS"}
+    handlers = {}  # Dispatch table - opcodes mapped to instr_* methods (filled in after the class is defined)
+    # Operations of typed_binary - instructions with operands of types proven by TypeInference
+    typed_operations = {"ADD": operator.add, "SUB": operator.sub, "MUL": operator.mul, "LT": operator.lt,
+                        "GT": operator.gt, "EQ": operator.eq, "AND": operator.and_, "OR": operator.or_}
+
+    # Expected argument types of every instruction
+    param_types = {
+        # 0 ARGUMENTS
+        'CREATEFRAME': (),
+        'PUSHFRAME': (),
+        'POPFRAME': (),
+        'RETURN': (),
+        'BREAK': (),
+        # STACK EXTENSION
+        'CLEARS': (),
+        'ADDS': (),
+        'SUBS': (),
+        'MULS': (),
+        'IDIVS': (),
+        'LTS': (),
+        'GTS': (),
+        'EQS': (),
+        'ANDS': (),
+        'ORS': (),
+        'NOTS': (),
+        'INT2CHARS': (),
+        'STRI2INTS': (),
+        'JUMPIFEQS': ('label',),
+        'JUMPIFNEQS': ('label',),
+        # 1 ARGUMENT
+        'DEFVAR': ('var',),
+        'CALL': ('label',),
+        'PUSHS': ('symb',),
+        'POPS': ('var',),
+        'WRITE': ('symb',),
+        'LABEL': ('label',),
+        'JUMP': ('label',),
+        'EXIT': ('symb',),
+        'DPRINT': ('symb',),
+        # 2 ARGUMENTS
+        'MOVE': ('var', 'symb'),
+        'INT2CHAR': ('var', 'symb'),
+        'READ': ('var', 'type'),
+        'STRLEN': ('var', 'symb'),
+        'TYPE': ('var', 'symb'),
+        'NOT': ('var', 'symb'),
+        # 3 ARGUMENTS
+        'ADD': ('var', 'symb', 'symb'),
+        'SUB': ('var', 'symb', 'symb'),
+        'MUL': ('var', 'symb', 'symb'),
+        'IDIV': ('var', 'symb', 'symb'),
+        'LT': ('var', 'symb', 'symb'),
+        'GT': ('var', 'symb', 'symb'),
+        'EQ': ('var', 'symb', 'symb'),
+        'AND': ('var', 'symb', 'symb'),
+        'OR': ('var', 'symb', 'symb'),
+        'STRI2INT': ('var', 'symb', 'symb'),
+        'CONCAT': ('var', 'symb', 'symb'),
+        'GETCHAR': ('var', 'symb', 'symb'),
+        'SETCHAR': ('var', 'symb', 'symb'),
+        'JUMPIFEQ': ('label', 'symb', 'symb'),
+        'JUMPIFNEQ': ('label', 'symb', 'symb')
+    }
+
+    def __init__(self, order, name, arg1, arg2, arg3, arg1_type, arg2_type, arg3_type):
+        """Instruction constructor
+
+           Takes the order tag for error reporting, opcode and arguments along with types from the XML. Arguments must
+           be already checked by Schema.check_instruction (or come from the program cache, where only checked
+           instructions are stored).
+        """
+        self.order = order
+        self.name = name
+        self.target = None  # Index of the jump target in the instruction array (resolved by Program.compile)
+        self.typed = False  # Type checks of the instruction can't fail (set by TypeInference)
+        self.argv = []
+        self.arg_types = []
+        if arg1_type:
+            self.argv.append(arg1)
+            self.arg_types.append(arg1_type)
+        if arg2_type:
+            self.argv.append(arg2)
+            self.arg_types.append(arg2_type)
+        if arg3_type:
+            self.argv.append(arg3)
+            self.arg_types.append(arg3_type)
+
+        try:
+            self.expected_arg_types = self.param_types[name]
+        except KeyError:
+            raise XMLStructureError("Unknown instruction name.", order)
+
+        # Method implementing the opcode is bound once, execution calls it directly
+        self.handler = MethodType(self.handlers[name], self)
+
+        # Operands are decoded once here, execution doesn't work with the XML strings
+        self.operands = []
+        for (arg, arg_type) in zip(self.argv, self.arg_types):
+            if arg_type == "var":
+                self.operands.append(VarRef(arg))
+            elif arg_type in self.accepted_const:
+                try:
+                    self.operands.append(Constant(arg_type, arg))
+                except ValueError:
+                    raise XMLStructureError("Constant {} is not a valid integer.".format(arg), self.order)
+            else:
+                # Labels and type names are used as they are
+                self.operands.append(arg)
+
+    def text(self):
+        '''Instruction in IPPcode19 syntax
+
+           @return Opcode and arguments, constants are written with their types and escape sequences
+        '''
+        words = [self.name]
+        for (arg, arg_type) in zip(self.argv, self.arg_types):
+            if arg_type in self.accepted_const:
+                if arg_type == "string":
+                    # Whitespace, # and \ must be written as escape sequences
+                    arg = "".join("\\{:03d}".format(ord(char)) if ord(char) <= 32 or char in "#\\" else char
+                                  for char in arg)
+                arg = arg_type + "@" + arg
+            words.append(arg)
+
+        return " ".join(words)
+
+    def read_symb(self, program_instance, arg_idx, order):
+        '''Helper function that reads expected symbol argument
+
+           @program_instance Instance of a program class - for getting variables
+           @arg_idx Index of the desired argument (1-3)
+           @return Value of a variable or a constant
+        '''
+        return self.operands[arg_idx - 1].read(program_instance.frameset, order)
+
+    def execute(self, program_instance):
+        """Interpretation caller
+
+           This function calls the instr_* method bound to the instruction by its constructor. The method does the
+           actual interpretation. Every instruction is independent, so they can be executed separately. The main loop
+           calls the handler directly to save a call.
+
+           @arg program_instance program instance is passed because some instructions change the control flow or modify
+                                 its member variables (e.g. frame stack)
+        """
+        self.handler(program_instance)
+
+    # 0 ARGUMENTS
+    def instr_createframe(self, program_instance):
+        program_instance.frameset.init_temporary_frame()
+
+    def instr_pushframe(self, program_instance):
+        program_instance.frameset.push_temp(self.order)
+
+    def instr_popframe(self, program_instance):
+        program_instance.frameset.pop_local(self.order)
+
+    def instr_return(self, program_instance):
+        try:
+            jumpto = program_instance.callstack.pop()
+        except IndexError:
+            raise MissingValueError("Can't return, call stack is empty.", self.order)
+        program_instance.pc = jumpto
+
+    def instr_break(self, program_instance):
+        frameset = program_instance.frameset
+        lines = ["Code position (from order attribute): " + str(self.order), "GLOBAL FRAME:"]
+        for name, variable in frameset.global_frame.items():
+            lines.append("GF@" + name + ": " + str(variable.get_value()))
+        lines.append("")
+        lines.append("TEMPORARY FRAME:")
+        if frameset.temporary_frame is None:
+            lines.append("Undefined")
+        else:
+            for name, variable in frameset.temporary_frame.items():
+                lines.append("TF@" + name + ": " + str(variable.get_value()))
+        lines.append("")
+
+        frames_under = len(frameset.local_frame_stack) - 1
+        lines.append("LOCAL FRAME:")
+        if frames_under < 0:
+            lines.append("Undefined")
+        else:
+            lines.append("Top frame (on top of " + str(frames_under) + " frames):")
+            for name, variable in frameset.local_frame_stack[-1].items():
+                lines.append("LF@" + name + ": " + str(variable.get_value()))
+
+        # Written through the buffer to keep the order with DPRINT output
+        program_instance.debug_output.write("\n".join(lines) + "\n")
+
+    # 1 ARGUMENT
+    def instr_defvar(self, program_instance):
+        try:
+            program_instance.frameset.set_var(self.operands[0])
+        except KeyError:
+            raise SemanticError("Variable {} is already defined.".format(self.operands[0].name), self.order)
+
+    def instr_call(self, program_instance):
+        if self.target is None:
+            raise SemanticError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+        if len(program_instance.callstack) >= program_instance.max_calls:
+            raise CallDepthError("Call stack is deeper than {} calls.".format(program_instance.max_calls), self.order)
+        # Program counter already points to the next instruction
+        program_instance.callstack.append(program_instance.pc)
+        program_instance.pc = self.target
+
+    def instr_pushs(self, program_instance):
+        program_instance.data_stack.append(self.operands[0].read(program_instance.frameset, self.order))
+
+    def instr_pops(self, program_instance):
+        try:
+            value = program_instance.data_stack.pop()
+        except IndexError:
+            raise MissingValueError("Data stack is empty.", self.order)
+        program_instance.frameset.update_var(self.operands[0], value, self.order)
+
+    def instr_write(self, program_instance):
+        retval = self.read_symb(program_instance, 1, self.order)
+
+        if retval is True:
+            retval = "true"
 
         if retval is False:
             retval = "false"
@@ -798,367 +2007,1334 @@ class Instruction:
         if retval is None:
             retval = "nil"
 
-        print(retval, end='')
+        program_instance.output.write(str(retval))
 
     def instr_label(self, program_instance):
         # DO NOTHING
         pass
 
     def instr_jump(self, program_instance):
-        try:
-            jumpto = program_instance.labels[self.argv[0]]
-        except KeyError:
-            print("interpret.py:", self.order, ": Label", self.argv[0], " doesn't exist.",
-                  file=sys.stderr, sep='')
-            sys.exit(57)
-        program_instance.order_jumpto = jumpto
+        if self.target is None:
+            raise OperandValueError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+        program_instance.pc = self.target
 
     def instr_exit(self, program_instance):
         retval = self.read_symb(program_instance, 1, self.order)
+        if type(retval) is not int:
+            raise OperandTypeError("Exit code must be of type int.", self.order)
         if retval < 0 or retval > 49:
-            print("interpret.py:", self.order, ": Invalid exit code.",
-                  file=sys.stderr, sep='')
-            sys.exit(57)
+            raise OperandValueError("Invalid exit code.", self.order)
 
-        sys.exit(retval)
+        raise ProgramExit(retval)
 
     def instr_dprint(self, program_instance):
-        print(self.read_symb(program_instance, 1, self.order), end='', file=sys.stderr)
+        program_instance.debug_output.write(str(self.read_symb(program_instance, 1, self.order)))
 
     # 2 ARGUMENTS
     def instr_move(self, program_instance):
         value = self.read_symb(program_instance, 2, self.order)
-        program_instance.frameset.update_var(self.argv[0], value, self.order)
+        program_instance.frameset.update_var(self.operands[0], value, self.order)
 
     def instr_int2char(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
-        if isinstance(arg2, int):
+        if type(arg2) is int:
             try:
                 result = chr(arg2)
             except ValueError:
-                print("interpret.py:", self.order, ": Argument 1 out of range - not a Unicode value.",
-                      file=sys.stderr, sep='')
-                sys.exit(58)
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+                raise StringError("Argument 1 out of range - not a Unicode value.", self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last argument must be of type string.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last argument must be of type string.", self.order)
 
     def instr_read(self, program_instance):
-        if program_instance.stdin_file is not False:
-            text = program_instance.stdin_file.readline()
-            if text != "\n":
-                # Not stripping "\n" because this is an empty line. When EOF is reached, "" is returned,
-                # so it'd also interfere
-                text.strip('\n')
-        else:
-            try:
-                text = input()
-            except EOFError or UnicodeError:
-                text = ""
+        if program_instance.input is None:
+            program_instance.set_input(sys.stdin)
+
+        if program_instance.output.line_buffered:
+            # Interactive use - show output written so far before waiting for input
+            program_instance.output.flush()
+
+        text = program_instance.input.readline()
+        if text is None:
+            # End of input, implicit value is used
+            text = ""
 
         # Text conversion
         # Save implicit value when text == ""
-        type = self.argv[1]
+        type = self.operands[1]
         if type == "int":
             # Error string "" will also fail conversion, no need for separate if clause
             try:
                 converted_int = int(text)
             except ValueError:
                 converted_int = 0
-            program_instance.frameset.update_var(self.argv[0], converted_int, self.order)
+            program_instance.frameset.update_var(self.operands[0], converted_int, self.order)
         elif type == "bool":
-            if text == "":
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
-            else:
-                if text.lower() == "true":
-                    program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-                elif text.lower() == "false":
-                    program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
-                else:
-                    # Implicit value when conversion is unsuccessful
-                    program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
+            # Anything else than true (case insensitive) is false, including the implicit value
+            program_instance.frameset.update_var(self.operands[0], text.lower() == "true", self.order)
         elif type == "string":
             # Implicit value is the same as error value
-            program_instance.frameset.update_var(self.argv[0], text, self.order)
+            program_instance.frameset.update_var(self.operands[0], text, self.order)
         else:
-            print("interpret.py:", self.order, ": Variable ", self.argv[0], " is undefined.",
-                  file=sys.stderr, sep='')
-            sys.exit(56)
+            raise MissingValueError("Variable {} is undefined.".format(self.operands[0].name), self.order)
 
     def instr_strlen(self, program_instance):
-        arg2 = self.read_symb(program_instance, 2, self.order)
-        if isinstance(arg2, str):
+        arg2 = self.operands[1].read_chars(program_instance.frameset, self.order)
+        if type(arg2) is str or type(arg2) is list:
             result = len(arg2)
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last argument must be of type string.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last argument must be of type string.", self.order)
 
     def instr_type(self, program_instance):
-        arg2 = self.read_symb(program_instance, 2, self.order)
-        if self.arg_types[1] == "var":
-            result = program_instance.frameset.get_var(arg2, self.order).get_type()
+        operand = self.operands[1]
+        if isinstance(operand, VarRef):
+            result = program_instance.frameset.get_var(operand, self.order).get_type()
             if result == "undefined":
                 result = ""
         else:
-            result = self.arg_types[1]
+            result = operand.type
 
-        program_instance.frameset.update_var(self.argv[0], result, self.order)
+        program_instance.frameset.update_var(self.operands[0], result, self.order)
 
     def instr_not(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
-        if isinstance(arg2, bool):
+        if type(arg2) is bool:
             result = not arg2
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool or string.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type int, bool or string.", self.order)
 
     # 3 ARGUMENTS
     def instr_add(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, int) and isinstance(arg3, int):
+        if type(arg2) is int and type(arg3) is int:
             result = arg2 + arg3
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
 
     def instr_sub(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, int) and isinstance(arg3, int):
+        if type(arg2) is int and type(arg3) is int:
             result = arg2 - arg3
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
 
     def instr_mul(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, int) and isinstance(arg3, int):
+        if type(arg2) is int and type(arg3) is int:
             result = arg2 * arg3
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
 
     def instr_idiv(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, int) and isinstance(arg3, int):
+        if type(arg2) is int and type(arg3) is int:
             if arg3 == 0:
-                print("interpret.py:", self.order, ": Division by zero.", file=sys.stderr, sep='')
-                sys.exit(57)
+                raise OperandValueError("Division by zero.", self.order)
 
-            result = arg2 + arg3
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            result = arg2 // arg3
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
 
     def instr_lt(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if (isinstance(arg2, int) and isinstance(arg3, int)) or \
-           (isinstance(arg2, str) and isinstance(arg3, str)) or \
-           (isinstance(arg2, bool) and isinstance(arg3, bool)):
-            result = arg2 < arg3
-            if result is True:
-                program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-            else:
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
-        else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool or string.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+        result = self.compare_lt(arg2, arg3)
+        program_instance.frameset.update_var(self.operands[0], result, self.order)
 
     def instr_gt(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if (isinstance(arg2, int) and isinstance(arg3, int)) or \
-           (isinstance(arg2, str) and isinstance(arg3, str)) or \
-           (isinstance(arg2, bool) and isinstance(arg3, bool)):
-            result = arg2 > arg3
-            if result is True:
-                program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-            else:
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
-        else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool or string.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+        result = self.compare_gt(arg2, arg3)
+        program_instance.frameset.update_var(self.operands[0], result, self.order)
 
     def instr_eq(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if (isinstance(arg2, int) and isinstance(arg3, int)) or \
-           (isinstance(arg2, str) and isinstance(arg3, str)) or \
-           (isinstance(arg2, bool) and isinstance(arg3, bool)) or \
-           (arg2 is None and arg3 is None):
-            result = arg2 == arg3
-            if result is True:
-                program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-            else:
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
-        else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool, string or nil.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+        result = self.compare_eq(arg2, arg3)
+        program_instance.frameset.update_var(self.operands[0], result, self.order)
 
     def instr_and(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, bool) and isinstance(arg3, bool):
+        if type(arg2) is bool and type(arg3) is bool:
             result = arg2 and arg3
-            if result is True:
-                program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-            else:
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type bool.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type bool.", self.order)
 
     def instr_or(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, bool) and isinstance(arg3, bool):
+        if type(arg2) is bool and type(arg3) is bool:
             result = arg2 or arg3
-            if result is True:
-                program_instance.frameset.update_var(self.argv[0], "bool@true", self.order)
-            else:
-                program_instance.frameset.update_var(self.argv[0], "bool@false", self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type bool.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type bool.", self.order)
 
     def instr_stri2int(self, program_instance):
-        string = self.read_symb(program_instance, 2, self.order)
+        string = self.operands[1].read_chars(program_instance.frameset, self.order)
         idx = self.read_symb(program_instance, 3, self.order)
-        if isinstance(string, str) and isinstance(idx, int):
-            try:
-                result = ord(string[idx])
-            except IndexError:
-                print("interpret.py:", self.order, ": Last 2 arguments must be of type string.",
-                      file=sys.stderr, sep='')
-                sys.exit(58)
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+        if (type(string) is str or type(string) is list) and type(idx) is int:
+            if not 0 <= idx < len(string):
+                raise StringError("Last 2 arguments must be of type string.", self.order)
+            result = ord(string[idx])
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type string.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
 
     def instr_concat(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if isinstance(arg2, str) and isinstance(arg3, str):
+        if type(arg2) is str and type(arg3) is str:
             result = arg2 + arg3
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+            if len(result) > program_instance.max_string:
+                raise StringSizeError("String is longer than {} characters.".format(program_instance.max_string),
+                                      self.order)
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type string.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
 
     def instr_getchar(self, program_instance):
-        string = self.read_symb(program_instance, 2, self.order)
+        string = self.operands[1].read_chars(program_instance.frameset, self.order)
         idx = self.read_symb(program_instance, 3, self.order)
-        if isinstance(string, str) and isinstance(idx, int):
-            try:
-                result = string[idx]
-            except IndexError:
-                print("interpret.py:", self.order, ": Last 2 arguments must be of type string.",
-                      file=sys.stderr, sep='')
-                sys.exit(58)
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+        if (type(string) is str or type(string) is list) and type(idx) is int:
+            if not 0 <= idx < len(string):
+                raise StringError("Last 2 arguments must be of type string.", self.order)
+            result = string[idx]
+            program_instance.frameset.update_var(self.operands[0], result, self.order)
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type string.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
 
     def instr_setchar(self, program_instance):
-        string = self.read_var(program_instance, 1, self.order)
+        # The string is changed in place, it isn't read as a value
+        ref = self.operands[0]
+        variable = program_instance.frameset.get_var(ref, self.order)
+        if variable.type == "undefined":
+            raise MissingValueError("Variable {} is undefined.".format(ref.name), self.order)
         idx = self.read_symb(program_instance, 2, self.order)
         char = self.read_symb(program_instance, 3, self.order)
-        if isinstance(string, str) and isinstance(idx, int) and isinstance(char, str):
-            try:
-                result = string[:idx-1] + char[0] + string[idx:]
-            except IndexError:
-                print("interpret.py:", self.order, ": Last 2 arguments must be of type string and last string must be "
-                      "non-empty.", file=sys.stderr, sep='')
-                sys.exit(58)
-            program_instance.frameset.update_var(self.argv[0], result, self.order)
+        if variable.type in ("string", "builder") and type(idx) is int and type(char) is str:
+            if not 0 <= idx < variable.length() or not char:
+                raise StringError("Last 2 arguments must be of type string and last string must be non-empty.",
+                                  self.order)
+            variable.set_char(idx, char[0])
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type string.", file=sys.stderr, sep='')
-            sys.exit(53)
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
 
     def instr_jumpifeq(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if (isinstance(arg2, int) and isinstance(arg3, int)) or \
-           (isinstance(arg2, str) and isinstance(arg3, str)) or \
-           (isinstance(arg2, bool) and isinstance(arg3, bool)) or \
-           (arg2 is None and arg3 is None):
-            result = arg2 == arg3
-            if result is True:
-                try:
-                    jumpto = program_instance.labels[self.argv[0]]
-                except KeyError:
-                    print("interpret.py:", self.order, ": Label", self.argv[0], " doesn't exist.",
-                          file=sys.stderr, sep='')
-                    sys.exit(57)
-                program_instance.order_jumpto = jumpto
-        else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool, string or nil.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
+        if self.compare_eq(arg2, arg3):
+            if self.target is None:
+                raise OperandValueError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+            program_instance.pc = self.target
 
     def instr_jumpifneq(self, program_instance):
         arg2 = self.read_symb(program_instance, 2, self.order)
         arg3 = self.read_symb(program_instance, 3, self.order)
-        if (isinstance(arg2, int) and isinstance(arg3, int)) or \
-           (isinstance(arg2, str) and isinstance(arg3, str)) or \
-           (isinstance(arg2, bool) and isinstance(arg3, bool)) or \
-           (arg2 is None and arg3 is None):
-            result = arg2 == arg3
-            if result is False:
-                try:
-                    jumpto = program_instance.labels[self.argv[0]]
-                except KeyError:
-                    print("interpret.py:", self.order, ": Label", self.argv[0], " doesn't exist.",
-                          file=sys.stderr, sep='')
-                    sys.exit(57)
-                program_instance.order_jumpto = jumpto
+        if not self.compare_eq(arg2, arg3):
+            if self.target is None:
+                raise OperandValueError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+            program_instance.pc = self.target
+
+    # STACK EXTENSION - the second operand is popped and the result replaces the first one on the top of the data stack
+    def instr_clears(self, program_instance):
+        program_instance.data_stack.clear()
+
+    def instr_adds(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is int and type(arg3) is int:
+            stack[-1] = arg2 + arg3
         else:
-            print("interpret.py:", self.order, ": Last 2 arguments must be of type int, bool, string or nil.",
-                  file=sys.stderr, sep='')
-            sys.exit(53)
-
-
-class Args:
-    '''Arguments class
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
+
+    def instr_subs(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is int and type(arg3) is int:
+            stack[-1] = arg2 - arg3
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
+
+    def instr_muls(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is int and type(arg3) is int:
+            stack[-1] = arg2 * arg3
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
+
+    def instr_idivs(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is int and type(arg3) is int:
+            if arg3 == 0:
+                raise OperandValueError("Division by zero.", self.order)
 
-       Implements argument parsing and opening necessary files.
-    '''
-    def __init__(self):
-        '''Argument class constructor
+            stack[-1] = arg2 // arg3
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
+
+    def instr_lts(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        stack[-1] = self.compare_lt(arg2, arg3)
+
+    def instr_gts(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        stack[-1] = self.compare_gt(arg2, arg3)
+
+    def instr_eqs(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        stack[-1] = self.compare_eq(arg2, arg3)
+
+    def instr_ands(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is bool and type(arg3) is bool:
+            stack[-1] = arg2 and arg3
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type bool.", self.order)
+
+    def instr_ors(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack[-1]
+        if type(arg2) is bool and type(arg3) is bool:
+            stack[-1] = arg2 or arg3
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type bool.", self.order)
+
+    def instr_nots(self, program_instance):
+        stack = program_instance.data_stack
+        if not stack:
+            raise MissingValueError("Data stack is empty.", self.order)
+        if type(stack[-1]) is bool:
+            stack[-1] = not stack[-1]
+        else:
+            raise OperandTypeError("Argument must be of type bool.", self.order)
+
+    def instr_int2chars(self, program_instance):
+        stack = program_instance.data_stack
+        if not stack:
+            raise MissingValueError("Data stack is empty.", self.order)
+        if type(stack[-1]) is int:
+            try:
+                stack[-1] = chr(stack[-1])
+            except ValueError:
+                raise StringError("Argument 1 out of range - not a Unicode value.", self.order)
+        else:
+            raise OperandTypeError("Argument must be of type int.", self.order)
+
+    def instr_stri2ints(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        idx = stack.pop()
+        string = stack[-1]
+        if type(string) is str and type(idx) is int:
+            if not 0 <= idx < len(string):
+                raise StringError("Last 2 arguments must be of type string.", self.order)
+            stack[-1] = ord(string[idx])
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
+
+    def instr_jumpifeqs(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack.pop()
+        if self.compare_eq(arg2, arg3):
+            if self.target is None:
+                raise OperandValueError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+            program_instance.pc = self.target
+
+    def instr_jumpifneqs(self, program_instance):
+        stack = program_instance.data_stack
+        if len(stack) < 2:
+            raise MissingValueError("Data stack is empty.", self.order)
+        arg3 = stack.pop()
+        arg2 = stack.pop()
+        if not self.compare_eq(arg2, arg3):
+            if self.target is None:
+                raise OperandValueError("Label {} doesn't exist.".format(self.operands[0]), self.order)
+            program_instance.pc = self.target
+
+    # FUSED HANDLERS - installed by Program.specialize
+    def fuse_compare_branch(self, branch):
+        '''Prepares fusion of a comparison with a conditional jump
+
+           Matches LT/GT/EQ var symb symb followed by JUMPIFEQ/JUMPIFNEQ label var bool (or label bool var) on the
+           same variable.
+           @param branch Instruction that follows this one
+           @return True when the pair can be fused
+        '''
+        if self.name not in self.compare_opcodes or not isinstance(branch, Instruction) or \
+                branch.name not in ("JUMPIFEQ", "JUMPIFNEQ"):
+            return False
+
+        (_, left, right) = branch.operands
+        if isinstance(left, VarRef) and isinstance(right, Constant):
+            (variable, constant) = (left, right)
+        elif isinstance(right, VarRef) and isinstance(left, Constant):
+            (variable, constant) = (right, left)
+        else:
+            return False
+        if variable.name != self.operands[0].name or constant.type != "bool":
+            return False
+
+        self.branch = branch
+        self.branch_value = constant.value
+        if self.typed:
+            self.compare = self.typed_operations[self.name]
+        else:
+            self.compare = {"LT": self.compare_lt, "GT": self.compare_gt, "EQ": self.compare_eq}[self.name]
+        return True
+
+    def fused_compare_branch(self, program_instance):
+        '''Comparison and conditional jump in one step
+
+           Result is stored to the variable as by the comparison alone, but the jump uses the computed value instead of
+           reading it back. Errors of the jump are reported with its order.
+        '''
+        frameset = program_instance.frameset
+        result = self.compare(self.operands[1].read(frameset, self.order), self.operands[2].read(frameset, self.order))
+        frameset.update_var(self.operands[0], result, self.order)
+
+        # The jump is executed from here on, it's counted for --insts
+        program_instance.fused += 1
+        branch = self.branch
+        if branch.compare_eq(result, self.branch_value) == (branch.name == "JUMPIFEQ"):
+            if branch.target is None:
+                raise OperandValueError("Label {} doesn't exist.".format(branch.operands[0]), branch.order)
+            program_instance.pc = branch.target
+        else:
+            # Skip the jump
+            program_instance.pc += 1
+
+    def fuse_increment(self):
+        '''Prepares in-place increment
+
+           Matches ADD x x int, ADD x int x and SUB x x int.
+           @return True when the instruction can change the variable in place
+        '''
+        if self.name not in ("ADD", "SUB"):
+            return False
+
+        (destination, left, right) = self.operands
+        if isinstance(left, VarRef) and left.name == destination.name and isinstance(right, Constant):
+            step = right
+        elif self.name == "ADD" and isinstance(right, VarRef) and right.name == destination.name and \
+                isinstance(left, Constant):
+            step = left
+        else:
+            return False
+        if step.type != "int":
+            return False
+
+        self.step = step.value if self.name == "ADD" else -step.value
+        return True
+
+    def fused_increment(self, program_instance):
+        '''Adds a constant to a variable in place
+
+           The variable is looked up once. It's already initialized, so the number of initialized variables doesn't
+           change.
+        '''
+        ref = self.operands[0]
+        variable = program_instance.frameset.get_var(ref, self.order)
+        if variable.type == "undefined":
+            raise MissingValueError("Variable {} is undefined.".format(ref.name), self.order)
+
+        if variable.type == "int":
+            variable.value += self.step
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type int.", self.order)
+
+    def fuse_append(self):
+        '''Prepares in-place concatenation
+
+           Matches CONCAT x x symb.
+           @return True when the instruction can append to the variable in place
+        '''
+        if self.name != "CONCAT":
+            return False
+
+        (destination, left, _) = self.operands
+        return isinstance(left, VarRef) and left.name == destination.name
+
+    def fused_append(self, program_instance):
+        '''Appends a string to a variable in place
+
+           Errors are checked in the same order as by CONCAT - the variable first, then the appended operand.
+        '''
+        ref = self.operands[0]
+        frameset = program_instance.frameset
+        variable = frameset.get_var(ref, self.order)
+        if variable.type == "undefined":
+            raise MissingValueError("Variable {} is undefined.".format(ref.name), self.order)
+
+        suffix = self.operands[2].read(frameset, self.order)
+        if variable.type in ("string", "builder") and type(suffix) is str:
+            if variable.length() + len(suffix) > program_instance.max_string:
+                raise StringSizeError("String is longer than {} characters.".format(program_instance.max_string),
+                                      self.order)
+            variable.append(suffix)
+        else:
+            raise OperandTypeError("Last 2 arguments must be of type string.", self.order)
+
+    def fused_push_constant(self, program_instance):
+        '''PUSHS of a constant operand'''
+        program_instance.data_stack.append(self.operands[0].value)
+
+    # TYPED HANDLERS - installed by Program.specialize for instructions marked by TypeInference
+    def typed_binary(self, program_instance):
+        '''Operation with operands of proven types
+
+           Same as the instr_* method without the type checks, the operation is taken from typed_operations.
+        '''
+        frameset = program_instance.frameset
+        arg2 = self.operands[1].read(frameset, self.order)
+        arg3 = self.operands[2].read(frameset, self.order)
+        frameset.update_var(self.operands[0], self.operation(arg2, arg3), self.order)
+
+    def typed_idiv(self, program_instance):
+        '''IDIV with int operands
+
+           Only division by zero is checked.
+        '''
+        frameset = program_instance.frameset
+        arg2 = self.operands[1].read(frameset, self.order)
+        arg3 = self.operands[2].read(frameset, self.order)
+        if arg3 == 0:
+            raise OperandValueError("Division by zero.", self.order)
+        frameset.update_var(self.operands[0], arg2 // arg3, self.order)
+
+    def typed_concat(self, program_instance):
+        '''CONCAT with string operands
+
+           Only the length of the result is checked.
+        '''
+        frameset = program_instance.frameset
+        result = self.operands[1].read(frameset, self.order) + self.operands[2].read(frameset, self.order)
+        if len(result) > program_instance.max_string:
+            raise StringSizeError("String is longer than {} characters.".format(program_instance.max_string),
+                                  self.order)
+        frameset.update_var(self.operands[0], result, self.order)
+
+    # COMPARISONS - shared by relational instructions, conditional jumps and their superinstructions
+    def compare_lt(self, arg2, arg3):
+        '''Operation of LT
+
+           @return True when arg2 is less than arg3
+           @throws OperandTypeError When the values can't be compared
+        '''
+        # Values of the same Python type have the same IPPcode19 type, nil is the only one without an order
+        if type(arg2) is type(arg3) and arg2 is not None:
+            return arg2 < arg3
+
+        raise OperandTypeError("Last 2 arguments must be of type int, bool or string.", self.order)
+
+    def compare_gt(self, arg2, arg3):
+        '''Operation of GT
+
+           @return True when arg2 is greater than arg3
+           @throws OperandTypeError When the values can't be compared
+        '''
+        if type(arg2) is type(arg3) and arg2 is not None:
+            return arg2 > arg3
+
+        raise OperandTypeError("Last 2 arguments must be of type int, bool or string.", self.order)
+
+    def compare_eq(self, arg2, arg3):
+        '''Operation of EQ, JUMPIFEQ and JUMPIFNEQ
+
+           @return True when the values are equal
+           @throws OperandTypeError When the values can't be compared
+        '''
+        if type(arg2) is type(arg3):
+            return arg2 == arg3
+
+        raise OperandTypeError("Last 2 arguments must be of type int, bool, string or nil.", self.order)
+
+
+# Build the dispatch table from instr_* methods - opcode is the upper case method name without the prefix
+Instruction.handlers = {name[len("instr_"):].upper(): method for (name, method) in vars(Instruction).items()
+                        if name.startswith("instr_")}
+
+
+class Superinstruction:
+    '''Sequence of instructions executed by one dispatch
+
+       Created by Optimizer from pairs of instructions that often follow each other. Parts are executed by their own
+       handlers, so errors are reported with the order of the part that failed. The first part never changes the
+       program counter and the second part is never a jump target, so the sequence can't be entered in the middle.
+    '''
+    def __init__(self, parts):
+        '''Superinstruction constructor
+
+           @param parts List of two instances of Instruction
+        '''
+        self.parts = parts
+        self.order = parts[0].order
+        self.name = "+".join(part.name for part in parts)
+        self.target = None
+        self.operands = []
+        (self.first, self.second) = (parts[0].handler, parts[1].handler)
+
+    def handler(self, program_instance):
+        '''Executes the parts
+
+           @param program_instance Instance of Program
+        '''
+        self.first(program_instance)
+        # Counted for --insts as a separate instruction
+        program_instance.fused += 1
+        self.second(program_instance)
+
+    def text(self):
+        '''Parts in IPPcode19 syntax
+
+           @return Parts separated by semicolons
+        '''
+        return " ; ".join(part.text() for part in self.parts)
+
+
+class ConstantFolder:
+    '''Program stand-in for constant folding
+
+       Optimizer executes instructions with constant operands on this object instead of a program, so the result is
+       computed by the same code as at runtime. It takes the role of both the program and its frameset - writes to the
+       destination variable are captured and the program counter shows whether a jump was taken.
+    '''
+    def __init__(self, max_string=sys.maxsize):
+        '''ConstantFolder constructor
+
+           Prepares the stand-in for one instruction.
+           @param max_string String limit of the runs, longer results of CONCAT aren't folded
+        '''
+        self.frameset = self
+        self.pc = None
+        self.value = None
+        self.max_string = max_string
+
+    def update_var(self, ref, value, order):
+        '''Captures the result of the instruction
+
+           @param ref Destination operand
+           @param value Computed value
+           @param order Order tag of the instruction
+        '''
+        self.value = value
+
+    def get_var(self, ref, order):
+        '''Only constants are folded, so no variable can be read'''
+        raise LookupError(ref.name)
+
+
+class Optimizer:
+    '''Peephole optimizer (-O)
+
+       Rewrites the compiled instruction array. Constant operations are folded, conditional jumps with constant
+       operands become unconditional or disappear, jump chains are threaded, jumps to the next instruction, unreachable
+       code and labels that nothing jumps to are removed and common pairs of instructions are merged into
+       superinstructions. Output, return codes and error messages (including orders) don't change, only the number of
+       executed instructions does. Instructions that would fail are left as they are, so they fail at runtime.
+    '''
+    # Instructions that only read their symbol operands and write the result to the variable in the first argument
+    foldable_opcodes = {"ADD", "SUB", "MUL", "IDIV", "LT", "GT", "EQ", "AND", "OR", "NOT", "INT2CHAR", "STRLEN",
+                        "STRI2INT", "CONCAT", "GETCHAR", "TYPE"}
+    # Instructions that never continue with the next instruction
+    terminal_opcodes = {"JUMP", "EXIT", "RETURN"}
+    # Instructions that change the program counter
+    control_opcodes = {"CALL", "JUMP", "JUMPIFEQ", "JUMPIFNEQ", "JUMPIFEQS", "JUMPIFNEQS", "EXIT", "RETURN", "LABEL"}
+
+    def __init__(self, max_string=sys.maxsize):
+        '''Optimizer constructor
+
+           @param max_string Maximum length of strings built by CONCAT in the runs of the program (--max-string)
+        '''
+        self.max_string = max_string
+
+    def optimize(self, program):
+        '''Optimizes a compiled program
+
+           @param program Instance of Program after compile
+        '''
+        code = []
+        for instruction in program.program:
+            replacement = self.fold(instruction)
+            if replacement is not None:
+                code.append(replacement)
+
+        changed = True
+        while changed:
+            (code, changed) = self.simplify_jumps(code)
+
+        program.program = self.fuse(code)
+        program.link()
+
+    @staticmethod
+    def constant_type(value):
+        '''Type of a folded value
+
+           @param value Python value computed by an instruction
+           @return Tuple of the type and the text of a constant with the value
+        '''
+        const_type = Variable.type_names[type(value)]
+        if const_type == "nil":
+            return ("nil", "nil")
+        if const_type == "bool":
+            return ("bool", "true" if value else "false")
+        if const_type == "int":
+            return ("int", str(value))
+
+        return ("string", value)
+
+    def fold(self, instruction):
+        '''Folds an instruction with constant operands
+
+           @param instruction Instance of Instruction
+           @return Replacement instruction, the same instruction when it can't be folded, None when it can be removed
+        '''
+        name = instruction.name
+        if name not in self.foldable_opcodes and name not in ("JUMPIFEQ", "JUMPIFNEQ"):
+            return instruction
+        if not all(isinstance(operand, Constant) for operand in instruction.operands[1:]):
+            return instruction
+
+        folder = ConstantFolder(self.max_string)
+        try:
+            # Plain handler - fused handlers expect a real program
+            Instruction.handlers[name](instruction, folder)
+        except InterpretError:
+            # Error must be reported at runtime, when the instruction is executed
+            return instruction
+
+        if name in ("JUMPIFEQ", "JUMPIFNEQ"):
+            if folder.pc is None:
+                # Never taken
+                return None
+            jump = Instruction(instruction.order, "JUMP", instruction.operands[0], None, None, "label", None, None)
+            return jump
+
+        (const_type, text) = self.constant_type(folder.value)
+        move = Instruction(instruction.order, "MOVE", instruction.argv[0], text, None, "var", const_type, None)
+        # Destination keeps its frame slot
+        move.operands[0] = instruction.operands[0]
+
+        return move
+
+    def simplify_jumps(self, code):
+        '''One pass of control flow simplifications
+
+           @param code List of instructions
+           @return Tuple of the new list of instructions and a flag whether anything changed
+        '''
+        labels = {}
+        for (idx, instruction) in enumerate(code):
+            if instruction.name == "LABEL":
+                labels[instruction.operands[0]] = idx
+
+        def next_real(idx):
+            # Index of the first instruction that isn't a label, starting at idx
+            while idx < len(code) and code[idx].name == "LABEL":
+                idx += 1
+            return idx
+
+        changed = False
+
+        # Jump threading - jumps to an unconditional jump go directly to its target
+        for instruction in code:
+            if instruction.name not in Instruction.jump_opcodes:
+                continue
+            label = instruction.operands[0]
+            visited = {label}
+            while label in labels:
+                idx = next_real(labels[label])
+                if idx >= len(code) or code[idx].name != "JUMP" or code[idx].operands[0] not in labels or \
+                        code[idx].operands[0] in visited:
+                    break
+                label = code[idx].operands[0]
+                visited.add(label)
+            if label != instruction.operands[0]:
+                instruction.operands[0] = label
+                instruction.argv[0] = label
+                changed = True
+
+        result = []
+        reachable = True
+        for (idx, instruction) in enumerate(code):
+            if instruction.name == "LABEL":
+                reachable = True
+            if not reachable:
+                # Nothing falls through to this instruction and it isn't a label
+                changed = True
+                continue
+
+            label = instruction.operands[0] if instruction.name == "JUMP" else None
+            if label in labels and next_real(idx + 1) > labels[label] > idx:
+                # Jump to the next instruction, only labels are between them
+                changed = True
+                continue
+
+            result.append(instruction)
+            if instruction.name in self.terminal_opcodes:
+                reachable = False
+
+        referenced = {instruction.operands[0] for instruction in result if instruction.name in Instruction.jump_opcodes}
+        code = []
+        for instruction in result:
+            if instruction.name == "LABEL" and instruction.operands[0] not in referenced:
+                changed = True
+                continue
+            code.append(instruction)
+
+        return (code, changed)
+
+    def fusible(self, first, second):
+        '''Checks whether two instructions form a superinstruction
+
+           @param first Instruction
+           @param second Instruction that follows the first one
+           @return True for pairs DEFVAR x + MOVE x, CREATEFRAME + PUSHFRAME and MOVE x + an instruction that reads x
+        '''
+        if not isinstance(first, Instruction) or not isinstance(second, Instruction) or \
+                first.name in self.control_opcodes or second.name in self.control_opcodes:
+            return False
+
+        if first.name == "DEFVAR" and second.name == "MOVE":
+            return first.operands[0].name == second.operands[0].name
+        if first.name == "CREATEFRAME" and second.name == "PUSHFRAME":
+            return True
+        if first.name == "MOVE":
+            return any(isinstance(operand, VarRef) and operand.name == first.operands[0].name
+                       for operand in second.operands[1:])
+
+        return False
+
+    def fuse(self, code):
+        '''Merges pairs of instructions into superinstructions
+
+           @param code List of instructions
+           @return New list of instructions
+        '''
+        result = []
+        idx = 0
+        while idx < len(code):
+            if idx + 1 < len(code) and self.fusible(code[idx], code[idx + 1]):
+                result.append(Superinstruction(code[idx:idx + 2]))
+                idx += 2
+            else:
+                result.append(code[idx])
+                idx += 1
+
+        return result
+
+
+class TypeInference:
+    '''Static type inference
+
+       Finds the types that every global variable can hold. Global variables live for the whole run, so the types of
+       a variable are the union of types of all values written to it anywhere in the program - results of arithmetic
+       are int, results of comparisons are bool, MOVE copies the types of its source and so on. Writes that copy other
+       variables are repeated until nothing changes. Variables in local and temporary frames can hold anything.
+
+       Instructions whose type checks can't fail with the inferred types are marked as typed. Program.specialize gives
+       them handlers without the checks and BlockCompiler doesn't write the checks out. Reads of the operands still
+       check that variables exist and have values.
+    '''
+    any_type = frozenset(("int", "bool", "string", "nil"))
+
+    # Types of results of instructions that write to a variable in the first argument
+    result_types = {"ADD": "int", "SUB": "int", "MUL": "int", "IDIV": "int", "STRLEN": "int", "STRI2INT": "int",
+                    "LT": "bool", "GT": "bool", "EQ": "bool", "AND": "bool", "OR": "bool", "NOT": "bool",
+                    "CONCAT": "string", "INT2CHAR": "string", "GETCHAR": "string", "TYPE": "string",
+                    "SETCHAR": "string"}
+    # Operand types that pass the checks of instructions with typed handlers, None means two operands of one type
+    checked_types = {"ADD": "int", "SUB": "int", "MUL": "int", "IDIV": "int", "AND": "bool", "OR": "bool",
+                     "CONCAT": "string", "LT": None, "GT": None, "EQ": None, "JUMPIFEQ": None, "JUMPIFNEQ": None}
+
+    def __init__(self):
+        '''TypeInference constructor
+
+           Global variables start without any types, they get them from writes.
+        '''
+        self.types = {}  # Identifiers of global variables mapped to frozensets of their possible types
+
+    def infer(self, program):
+        '''Infers types and marks typed instructions
+
+           @param program Instruction array
+        '''
+        instructions = []
+        for instruction in program:
+            instructions.extend(instruction.parts if isinstance(instruction, Superinstruction) else [instruction])
+        writes = [instruction for instruction in instructions
+                  if Instruction.param_types[instruction.name][:1] == ("var",) and instruction.name != "DEFVAR"]
+
+        changed = True
+        while changed:
+            changed = False
+            for instruction in writes:
+                ref = instruction.operands[0]
+                if ref.scope != "GF":
+                    continue
+                old = self.types.get(ref.identifier, frozenset())
+                new = old | self.written_types(instruction)
+                if new != old:
+                    self.types[ref.identifier] = new
+                    changed = True
+
+        for instruction in instructions:
+            instruction.typed = self.proves(instruction)
+
+    def written_types(self, instruction):
+        '''Types of values written by an instruction
+
+           @param instruction Instance of Instruction that writes to the variable in its first argument
+           @return Frozenset of types
+        '''
+        name = instruction.name
+        if name in self.result_types:
+            return frozenset((self.result_types[name],))
+        if name == "MOVE":
+            return self.operand_types(instruction.operands[1])
+        if name == "READ":
+            # Other type names end with an error
+            return frozenset((instruction.operands[1],)) & self.any_type
+
+        # POPS and instructions added later
+        return self.any_type
+
+    def operand_types(self, operand):
+        '''Possible types of an operand
+
+           @param operand Instance of Constant or VarRef
+           @return Frozenset of types
+        '''
+        if isinstance(operand, Constant):
+            return frozenset((operand.type,))
+        if operand.scope == "GF":
+            return self.types.get(operand.identifier, frozenset())
+
+        return self.any_type
+
+    def proves(self, instruction):
+        '''Checks whether type checks of an instruction can fail
+
+           A variable without any types has never been written, so reading it fails before the check.
+           @param instruction Instance of Instruction
+           @return True when the operands always pass the checks
+        '''
+        if instruction.name not in self.checked_types:
+            return False
+
+        expected = self.checked_types[instruction.name]
+        (left, right) = (self.operand_types(operand) for operand in instruction.operands[1:])
+        if expected is None:
+            # Comparison of two values of the same type, only equality accepts nil
+            return len(left | right) <= 1 and ("nil" not in left or instruction.name not in ("LT", "GT"))
+
+        return left <= {expected} and right <= {expected}
+
+
+class Block:
+    '''Basic block of the tiered execution
+
+       Instructions from a leader up to the next leader. Leaders are the first instruction, labels and instructions
+       that follow a jump, call, return or exit, so the block is always entered at its first instruction. The handler
+       of the first instruction in Program.handlers is replaced by method enter, which counts entries. The block is
+       interpreted instruction by instruction until it's entered threshold times, then it's compiled by BlockCompiler
+       and the compiled function executes the whole block in one step. Both charge all instructions of the block to
+       the instruction and time limits of the run when the block is entered.
+    '''
+    __slots__ = ("program", "handlers", "start", "end", "size", "threshold", "count", "first", "source")
+
+    def __init__(self, program, handlers, start, end, threshold):
+        '''Block constructor
+
+           @param program Instruction array
+           @param handlers Handler array of the program, index start is replaced when the block is compiled
+           @param start Index of the first instruction of the block
+           @param end Index after the last instruction of the block
+           @param threshold Number of entries before the block is compiled
+        '''
+        self.program = program
+        self.handlers = handlers
+        self.start = start
+        self.end = end
+        # Number of instructions, as counted by --insts - superinstructions count as their parts
+        self.size = sum(len(instruction.parts) if isinstance(instruction, Superinstruction) else 1
+                        for instruction in program[start:end])
+        self.threshold = threshold
+        self.count = 0                      # Number of entries so far
+        self.first = handlers[start]        # Handler of the first instruction
+        self.source = None                  # Generated source of the compiled block
+
+    def enter(self, program_instance):
+        '''Interpreted entry of the block
+
+           Executes only the first instruction, the main loop continues with the next ones.
+           @param program_instance Instance of Program
+        '''
+        program_instance.countdown -= self.size
+        if program_instance.countdown < 0:
+            program_instance.check_limits()
+
+        self.count += 1
+        if self.count == self.threshold:
+            (self.source, self.handlers[self.start]) = BlockCompiler().compile(self.program, self.start, self.end,
+                                                                               self.size)
+        self.first(program_instance)
+
+
+class BlockCompiler:
+    '''Basic block compiler (tiered execution)
+
+       Generates Python source of a function that executes a basic block and compiles it. Instructions are translated
+       one by one. Arithmetic, comparisons, logic, CONCAT, MOVE and jumps are written out with their operands bound as
+       locals of the function - values of constants are bound directly, global variables are read and written by their
+       slots and values written or read in the block are reused from locals until an instruction that isn't written
+       out could change them. Other instructions call their handlers.
+
+       Every instruction that is written out checks the types of its operands first, unless TypeInference proved
+       them. When the check fails, the block gives up - the program counter is set after the instruction and its
+       handler is called, so the error (or a case that isn't written out) is handled by the same code as in the
+       interpreter and the main loop continues with the next instruction.
+    '''
+    threshold = 20  # Default number of entries of a block before it's compiled
+
+    # Instructions with two int operands and the Python operators that implement them
+    arithmetic = {"ADD": "+", "SUB": "-", "MUL": "*", "IDIV": "//"}
+    # Comparisons and logic instructions - Python operators and checks of the operands ({a} and {b})
+    relations = {
+        "LT": ("<", "type({a}) is type({b}) and {a} is not None"),
+        "GT": (">", "type({a}) is type({b}) and {a} is not None"),
+        "EQ": ("==", "type({a}) is type({b})"),
+        "AND": ("and", "type({a}) is bool and type({b}) is bool"),
+        "OR": ("or", "type({a}) is bool and type({b}) is bool"),
+    }
+    # Instructions that change frames, values of all variables kept in locals become unknown
+    frame_opcodes = {"CREATEFRAME", "PUSHFRAME", "POPFRAME", "CALL", "RETURN"}
+    # Variable types whose value is read from the variable directly, others are read by VarRef.read
+    ready_types = frozenset(("int", "bool", "string", "nil"))
+
+    def __init__(self):
+        '''BlockCompiler constructor
+
+           Prepares the compiler for one block.
+        '''
+        self.lines = []                 # Lines of the function body
+        self.bound = {}                 # Names of locals mapped to the bound objects (operands and handlers)
+        self.names = {}                 # Identities of the bound objects mapped to the names of their locals
+        self.known = {}                 # Variable names mapped to expressions with their current values
+        self.types = {}                 # Expressions mapped to their IPPcode19 types when known
+        self.temps = 0                  # Number of created temporary locals
+        self.next = 0                   # Index after the instruction that is being translated
+        self.rest = []                  # Parts of the translated superinstruction from the current one on
+
+    def compile(self, program, start, end, size):
+        '''Compiles a basic block
+
+           @param program Instruction array
+           @param start Index of the first instruction of the block
+           @param end Index after the last instruction of the block
+           @param size Number of instructions charged to the limits when the block is entered
+           @return Pair of the generated source and the function that executes the block
+        '''
+        terminated = False
+        for idx in range(start, end):
+            instruction = program[idx]
+            parts = instruction.parts if isinstance(instruction, Superinstruction) else [instruction]
+            for (part_idx, part) in enumerate(parts):
+                (self.next, self.rest) = (idx + 1, parts[part_idx:])
+                terminated = self.translate(part)
+        if not terminated:
+            self.emit("program.pc = {}".format(end))
+
+        names = ", ".join("{0}={0}".format(name) for name in self.bound)
+        source = "def block(program{}):\n".format(", " + names if names else "")
+        source += "    program.countdown -= {}\n".format(size)
+        source += "    if program.countdown < 0:\n        program.check_limits()\n"
+        source += "    frameset = program.frameset\n    slots = frameset.global_frame.slots\n"
+        source += "".join("    " + line + "\n" for line in self.lines)
+
+        namespace = dict(self.bound, ready=self.ready_types, type_names=Variable.type_names)
+        exec(compile(source, "<block {}>".format(start), "exec"), namespace)
+
+        return (source, namespace["block"])
+
+    def translate(self, instruction):
+        '''Writes out one instruction
+
+           @param instruction Instance of Instruction
+           @return True when the instruction sets the program counter
+        '''
+        name = instruction.name
+        operands = instruction.operands
+        order = instruction.order
+
+        if name == "LABEL":
+            return False
+
+        if name == "MOVE":
+            value = self.read(operands[1], order)
+            self.write(operands[0], value, self.types.get(value), order)
+            return False
+
+        if name in self.arithmetic:
+            (a, b) = (self.read(operands[1], order), self.read(operands[2], order))
+            checks = [] if instruction.typed else ["type({a}) is int and type({b}) is int"]
+            if name == "IDIV":
+                checks.append("{b} != 0")
+            if checks:
+                self.check(" and ".join(checks), a, b)
+            self.write(operands[0], self.assign("{} {} {}".format(a, self.arithmetic[name], b), "int"), "int", order)
+            return False
+
+        if name in self.relations:
+            (symbol, check) = self.relations[name]
+            (a, b) = (self.read(operands[1], order), self.read(operands[2], order))
+            if not instruction.typed:
+                self.check(check, a, b)
+            self.write(operands[0], self.assign("{} {} {}".format(a, symbol, b), "bool"), "bool", order)
+            return False
+
+        if name == "NOT":
+            a = self.read(operands[1], order)
+            self.check("type({a}) is bool", a)
+            self.write(operands[0], self.assign("not " + a, "bool"), "bool", order)
+            return False
+
+        if name == "CONCAT" and not instruction.fuse_append():
+            # Concatenation onto the same variable is left to the handler that appends in place
+            (a, b) = (self.read(operands[1], order), self.read(operands[2], order))
+            if not instruction.typed:
+                self.check("type({a}) is str and type({b}) is str", a, b)
+            result = self.assign("{} + {}".format(a, b), "string")
+            # The handler reports a string over the limit
+            self.check("len({a}) <= program.max_string", result)
+            self.write(operands[0], result, "string", order)
+            return False
+
+        if name == "JUMP" and instruction.target is not None:
+            self.emit("program.pc = {}".format(instruction.target))
+            return True
+
+        if name in ("JUMPIFEQ", "JUMPIFNEQ") and instruction.target is not None:
+            (a, b) = (self.read(operands[1], order), self.read(operands[2], order))
+            if not instruction.typed:
+                self.check("type({a}) is type({b})", a, b)
+            self.emit("if {} {} {}:".format(a, "==" if name == "JUMPIFEQ" else "!=", b))
+            self.emit("    program.pc = {}".format(instruction.target))
+            self.emit("else:")
+            self.emit("    program.pc = {}".format(self.next))
+            return True
+
+        # Other instructions are executed by their handlers
+        if name in Optimizer.control_opcodes:
+            # Program counter must point after the instruction, as in the main loop
+            self.emit("program.pc = {}".format(self.next))
+        self.emit("{}(program)".format(self.bind(instruction.handler, "h")))
+        if name in self.frame_opcodes:
+            self.known.clear()
+        elif operands and isinstance(operands[0], VarRef):
+            self.known.pop(operands[0].name, None)
+
+        return name in Optimizer.control_opcodes
+
+    def emit(self, line):
+        '''Appends a line to the function body
+
+           @param line Python statement
+        '''
+        self.lines.append(line)
+
+    def bind(self, value, prefix):
+        '''Binds an object to a local of the function
+
+           @param value Bound object
+           @param prefix First letter of the local
+           @return Name of the local
+        '''
+        name = self.names.get(id(value))
+        if name is None:
+            name = "{}{}".format(prefix, len(self.bound))
+            self.bound[name] = value
+            self.names[id(value)] = name
+
+        return name
+
+    def assign(self, expression, value_type):
+        '''Stores a result to a new local
+
+           @param expression Python expression
+           @param value_type IPPcode19 type of the result
+           @return Name of the local
+        '''
+        name = "t{}".format(self.temps)
+        self.temps += 1
+        self.emit("{} = {}".format(name, expression))
+        self.types[name] = value_type
+
+        return name
+
+    def check(self, condition, a, b=None):
+        '''Writes out a check of operand types
+
+           Operands are substituted for {a} and {b} in the condition. When the check fails, the program counter is set
+           after the instruction, the instruction (with the rest of its superinstruction) is executed by its handler
+           and the block returns.
+           @param condition Python expression
+           @param a Expression of the first operand
+           @param b Expression of the second operand
+        '''
+        self.emit("if not ({}):".format(condition.format(a=a, b=b)))
+        self.emit("    program.pc = {}".format(self.next))
+        for part in self.rest:
+            self.emit("    {}(program)".format(self.bind(part.handler, "h")))
+        self.emit("    return")
+
+    def read(self, operand, order):
+        '''Writes out reading of an operand
+
+           @param operand Instance of Constant or VarRef
+           @param order Order of the instruction (for error reporting)
+           @return Python expression with the value
+        '''
+        if isinstance(operand, Constant):
+            name = self.bind(operand.value, "c")
+            self.types[name] = operand.type
+            return name
+
+        if operand.name in self.known:
+            return self.known[operand.name]
+
+        ref = self.bind(operand, "r")
+        name = "t{}".format(self.temps)
+        self.temps += 1
+        if operand.scope == "GF" and operand.slot is not None:
+            self.emit("v = slots[{}]".format(operand.slot))
+            self.emit("if v is not None and v.type in ready:")
+            self.emit("    {} = v.value".format(name))
+            self.emit("else:")
+            self.emit("    {} = {}.read(frameset, {})".format(name, ref, order))
+        else:
+            self.emit("{} = {}.read(frameset, {})".format(name, ref, order))
+        self.known[operand.name] = name
+
+        return name
+
+    def write(self, ref, value, value_type, order):
+        '''Writes out writing of a variable
+
+           @param ref Instance of VarRef
+           @param value Python expression with the value
+           @param value_type IPPcode19 type of the value, None when it isn't known
+           @param order Order of the instruction (for error reporting)
+        '''
+        name = self.bind(ref, "r")
+        if ref.scope == "GF" and ref.slot is not None:
+            # Initialized variable is changed directly, first write is counted by FrameSet
+            self.emit("v = slots[{}]".format(ref.slot))
+            self.emit("if v is not None and v.type != 'undefined':")
+            self.emit("    v.value = {}".format(value))
+            if value_type is None:
+                self.emit("    v.type = type_names[type({})]".format(value))
+            else:
+                self.emit("    v.type = {!r}".format(value_type))
+            self.emit("    v.chars = None")
+            self.emit("else:")
+            self.emit("    frameset.update_var({}, {}, {})".format(name, value, order))
+        else:
+            self.emit("frameset.update_var({}, {}, {})".format(name, value, order))
+        self.known[ref.name] = value
+
+
+class Args:
+    '''Arguments class
+
+       Implements argument parsing and opening necessary files.
+    '''
+    def __init__(self):
+        '''Argument class constructor
 
         '''
         self.source_file = False
         self.input_file = False
         self.help = False
-
-    def parse(self):
+        self.buffer_size = 65536
+        self.line_buffered = False
+        self.cache = True
+        self.cache_dir = ProgramCache.default_directory()
+        self.invalidate_cache = False
+        self.batch = False
+        self.server = False
+        self.workers = os.cpu_count() or 1
+        self.server_cache = 128
+        self.profile = False
+        self.stats = False
+        self.stats_items = []  # Statistics in the order of --insts and --vars arguments
+        self.optimize = False
+        self.dump_program = False
+        self.tier_threshold = BlockCompiler.threshold
+        self.limits = None  # Instance of Limits when any --max-* argument is given
+
+    def parse(self, argv):
         '''Argument parser
 
            Parses the arguments and handles argument logic. Prints help if needed.
+           @param argv Command line arguments without the script name
         '''
         try:
-            arguments, tail = getopt.getopt(sys.argv[1:], "", ["help", "source=", "input="])
+            arguments, tail = getopt.getopt(argv, "O", ["help", "source=", "input=", "buffer-size=",
+                                                                "line-buffered", "cache-dir=", "no-cache",
+                                                                "invalidate-cache", "batch=", "server=", "workers=",
+                                                                "server-cache=", "profile=", "stats=", "insts",
+                                                                "vars", "dump-program=", "tier-threshold=",
+                                                                "max-insts=", "max-time=", "max-calls=",
+                                                                "max-frames=", "max-string="])
         except getopt.GetoptError:
             print("interpret.py: Unknown argument.", file=sys.stderr)
             sys.exit(10)
@@ -1170,6 +3346,67 @@ class Args:
                 self.input_file = value
             elif arg == "--help":
                 self.help = True
+            elif arg == "--buffer-size":
+                try:
+                    self.buffer_size = int(value)
+                except ValueError:
+                    print("interpret.py: --buffer-size argument must be a number.", file=sys.stderr)
+                    sys.exit(10)
+            elif arg == "--line-buffered":
+                self.line_buffered = True
+            elif arg == "--cache-dir":
+                self.cache_dir = value
+            elif arg == "--no-cache":
+                self.cache = False
+            elif arg == "--invalidate-cache":
+                self.invalidate_cache = True
+            elif arg == "--batch":
+                self.batch = value
+            elif arg == "--server":
+                self.server = value
+            elif arg == "--profile":
+                self.profile = value
+            elif arg == "--stats":
+                self.stats = value
+            elif arg in ("--insts", "--vars"):
+                self.stats_items.append(arg[2:])
+            elif arg == "-O":
+                self.optimize = True
+            elif arg == "--dump-program":
+                self.dump_program = value
+            elif arg == "--tier-threshold":
+                try:
+                    self.tier_threshold = int(value)
+                except ValueError:
+                    self.tier_threshold = -1
+                if self.tier_threshold < 0:
+                    print("interpret.py: --tier-threshold argument must be a non-negative number.", file=sys.stderr)
+                    sys.exit(10)
+            elif arg in ("--max-insts", "--max-time", "--max-calls", "--max-frames", "--max-string"):
+                try:
+                    number = float(value) if arg == "--max-time" else int(value)
+                except ValueError:
+                    number = 0
+                if number <= 0:
+                    print("interpret.py: {} argument must be a positive number.".format(arg), file=sys.stderr)
+                    sys.exit(10)
+                if self.limits is None:
+                    self.limits = Limits()
+                name = {"--max-insts": "instructions", "--max-time": "time", "--max-calls": "calls",
+                        "--max-frames": "frames", "--max-string": "string"}[arg]
+                setattr(self.limits, name, number)
+            elif arg in ("--workers", "--server-cache"):
+                try:
+                    number = int(value)
+                except ValueError:
+                    number = 0
+                if number < 1:
+                    print("interpret.py: {} argument must be a positive number.".format(arg), file=sys.stderr)
+                    sys.exit(10)
+                if arg == "--workers":
+                    self.workers = number
+                else:
+                    self.server_cache = number
             else:
                 # Unhandled options
                 pass
@@ -1181,6 +3418,26 @@ class Args:
                 sys.exit(10)
             self.print_help()
 
+        if self.stats_items and self.stats is False:
+            print("interpret.py: --insts and --vars arguments require --stats.", file=sys.stderr)
+            sys.exit(10)
+
+        if self.batch is not False:
+            if self.input_file is not False or self.source_file is not False or self.server is not False or \
+                    self.profile is not False or self.stats is not False:
+                print("interpret.py: --batch argument can't be combined with --source, --input, --server, "
+                      "--profile or --stats.", file=sys.stderr)
+                sys.exit(10)
+            return
+
+        if self.server is not False:
+            if self.input_file is not False or self.source_file is not False or self.profile is not False or \
+                    self.stats is not False:
+                print("interpret.py: --server argument can't be combined with --source, --input, --profile or "
+                      "--stats.", file=sys.stderr)
+                sys.exit(10)
+            return
+
         if self.source_file is False and self.input_file is False:
             print("interpret.py: One of --source or --input argument is required.", file=sys.stderr)
             sys.exit(10)
@@ -1192,7 +3449,8 @@ class Args:
            Prints the help and ends the program successfully.
         '''
         print("USAGE:")
-        print("python3.6 interpret.py (--help | --source=SOURCE | --input=INPUT)")
+        print("python3.6 interpret.py (--help | --source=SOURCE | --input=INPUT | --batch=MANIFEST |")
+        print("                        --server=SOCKET)")
         print()
         print("DESCRIPTION:")
         print("This script interprets code from IPPcode19 XML representation. At least one ")
@@ -1205,63 +3463,632 @@ class Args:
         print("--input=INPUT    Expects a text file INPUT that will be provided to the")
         print("                 script as its standard input. In that case, source code is")
         print("                 read from stdin.")
+        print("--buffer-size=N  Output is written in chunks of N characters (65536 by")
+        print("                 default, 0 writes output of every instruction immediately).")
+        print("--line-buffered  Output is written after every newline and before reading")
+        print("                 from stdin. Useful for interactive use.")
+        print("--cache-dir=DIR  Checked programs are cached in directory DIR, repeated runs")
+        print("                 of the same source skip XML parsing (default is")
+        print("                 $XDG_CACHE_HOME/xipp or ~/.cache/xipp).")
+        print("--no-cache       Programs are neither read from nor written to the cache.")
+        print("--invalidate-cache")
+        print("                 Cached entry for the source is ignored and replaced.")
+        print("--batch=MANIFEST Runs all jobs listed in file MANIFEST in this process. Every")
+        print("                 line contains tab separated paths to the source, the input")
+        print("                 and the expected output and the expected return code. Only")
+        print("                 the source is required, - skips a field. Relative paths")
+        print("                 are relative to the manifest. Result of every job is")
+        print("                 printed as a line of JSON. Returns 0 when all jobs have")
+        print("                 the expected results, 1 otherwise.")
+        print("-O               Optimizes the program before execution - folds constants,")
+        print("                 removes unreachable code and unused labels, threads jumps")
+        print("                 and merges common pairs of instructions. Output and return")
+        print("                 codes don't change, numbers of executed instructions do.")
+        print("--tier-threshold=N")
+        print("                 Basic blocks entered N times are compiled to Python")
+        print("                 functions (20 by default, 0 keeps the program interpreted).")
+        print("--dump-program=FILE")
+        print("                 Writes the program as it's executed (after -O) to FILE.")
+        print("--profile=FILE   Measures execution count and time of every instruction,")
+        print("                 opcode, block starting with a label and called label.")
+        print("                 Sorted report is written to FILE, the same data as JSON")
+        print("                 to FILE.json and stacks for flame graphs to FILE.folded.")
+        print("--stats=FILE     Writes statistics selected by --insts and --vars to FILE,")
+        print("                 one number per line in the order of the arguments.")
+        print("--insts          Number of executed instructions.")
+        print("--vars           Maximum number of initialized variables in all valid")
+        print("                 frames at once.")
+        print("--server=SOCKET  Runs as a daemon that listens on Unix socket SOCKET. Every")
+        print("                 request is a line of JSON with the program XML in key")
+        print("                 \"source\" or a hash of a program sent before in key \"hash\"")
+        print("                 and the input in key \"input\". Output is sent back as")
+        print("                 lines of JSON {\"stdout\": ...}, {\"stderr\": ...} and")
+        print("                 {\"returncode\": ..., \"hash\": ...} at the end of the run.")
+        print("--max-insts=N    Ends the program after N executed instructions (return")
+        print("                 code 60).")
+        print("--max-time=S     Ends the program after S seconds (return code 61).")
+        print("--max-calls=N    Call stack can't be deeper than N calls (return code 62).")
+        print("--max-frames=N   Local frame stack can't be deeper than N frames (return")
+        print("                 code 63).")
+        print("--max-string=N   CONCAT can't build strings longer than N characters")
+        print("                 (return code 64).")
+        print("--workers=N      Number of server worker processes (number of processors by")
+        print("                 default).")
+        print("--server-cache=N Number of compiled programs kept by every server worker")
+        print("                 (128 by default).")
 
         sys.exit(0)
 
 
-"""
-SCRIPT EXECUTION POINT
-"""
-# Read arguments
-args = Args()
-args.parse()
+class Statistics:
+    '''Statistics of a run (STATI extension)
 
-# Implicitly false until set
-if args.source_file is not False:
-    try:
-        source_file = open(args.source_file)
-    except IOError:
-        print("interpret.py: File with source code not found.", file=sys.stderr)
-        sys.exit(11)
+       Filled by run when the program ends - normally, by EXIT or by an error. Counters are kept incrementally by the
+       main loop and by FrameSet, so collecting them costs almost nothing.
+    '''
+    def __init__(self):
+        '''Statistics constructor
+
+           Creates empty statistics.
+        '''
+        self.insts = 0  # Number of executed instructions
+        self.vars = 0   # Maximum number of initialized variables in all valid frames at once
+
+    def write(self, path, items):
+        '''Writes the statistics
+
+           @param path Path of the file with statistics
+           @param items Names of statistics (insts, vars) in the order in which they are written, one per line
+           @throws OSError When the file can't be written
+        '''
+        with open(path, "w") as stats_file:
+            for item in items:
+                print(getattr(self, item), file=stats_file)
+
+
+class Limits:
+    '''Execution budgets of a run
+
+       Quotas for untrusted programs, None means unlimited. Exceeding a limit ends the program with its own return
+       code. Instructions and time are checked by a countdown that blocks decrease when they're entered (see
+       Program.check_limits), depths of the call stack and the local frame stack by CALL and PUSHFRAME and the string
+       length by CONCAT.
+    '''
+    check_interval = 10000  # Instructions between checks of the time limit
+
+    def __init__(self, instructions=None, time=None, calls=None, frames=None, string=None):
+        '''Limits constructor
+
+           @param instructions Maximum number of executed instructions (return code 60)
+           @param time Maximum wall time of the execution in seconds (return code 61)
+           @param calls Maximum depth of the call stack (return code 62)
+           @param frames Maximum depth of the local frame stack (return code 63)
+           @param string Maximum length of a string built by CONCAT in characters (return code 64)
+        '''
+        self.instructions = instructions
+        self.time = time
+        self.calls = calls
+        self.frames = frames
+        self.string = string
+
+    @staticmethod
+    def string_limit(limits):
+        '''Maximum length of strings built by CONCAT
+
+           @param limits Instance of Limits or None
+           @return The string limit, sys.maxsize when strings aren't limited
+        '''
+        if limits is None or limits.string is None:
+            return sys.maxsize
+        return limits.string
+
+
+class RunResult:
+    '''Result of a finished program
+
+       Returned by run when the program ends normally or by instruction EXIT.
+    '''
+    def __init__(self, returncode):
+        '''RunResult constructor
+
+           @param returncode Return code of the program (0 or the value given to EXIT)
+        '''
+        self.returncode = returncode
+
+    def __repr__(self):
+        return "RunResult(returncode={})".format(self.returncode)
+
+
+def compile_program(program_source, cache=None, invalidate_cache=False, optimize=False,
+                    tier_threshold=BlockCompiler.threshold, limits=None):
+    '''Loads, checks and compiles a program
+
+       Compiled program can be passed to run any number of times, so the XML is parsed only once. Optimized program
+       should be run with the limits it was compiled with - strings over the string limit aren't folded, so CONCAT
+       reports them at runtime.
+       @param program_source XML representation of the program as a binary file object, bytes or str
+       @param cache Instance of ProgramCache, None disables caching
+       @param invalidate_cache Ignore and replace the cached entry for this program
+       @param optimize Rewrite the program by Optimizer
+       @param tier_threshold Number of entries of a basic block before it's compiled, 0 never compiles blocks
+       @param limits Instance of Limits of the runs, None when nothing is limited
+       @return Compiled instance of Program
+       @throws InterpretError Subclass with the return code of the error (XMLFormatError, XMLStructureError...)
+    '''
+    if isinstance(program_source, str):
+        program_source = program_source.encode("utf-8")
+    if isinstance(program_source, (bytes, bytearray)):
+        program_source = io.BytesIO(program_source)
+
+    program = Program()
+    program.tier_threshold = tier_threshold
+    program.load(program_source, cache, invalidate_cache)
+    program.compile()
+    if optimize:
+        Optimizer(Limits.string_limit(limits)).optimize(program)
+
+    return program
+
+
+def run(program_source, input_stream=None, output_stream=None, error_stream=None, buffer_size=65536,
+        line_buffered=False, cache=None, invalidate_cache=False, profiler=None, statistics=None, optimize=False,
+        limits=None):
+    '''Runs one program
+
+       Library entry point - loads, checks and executes the program without touching the process state, so it can be
+       called any number of times from one process. Output is flushed before this function returns or raises.
+       @param program_source XML representation of the program as a binary file object, bytes or str, or a program
+                             compiled by compile_program
+       @param input_stream File object with inputs for READ instructions, None reads standard input
+       @param output_stream Text stream for WRITE (standard output by default)
+       @param error_stream Text stream for DPRINT and BREAK (standard error output by default)
+       @param buffer_size Number of buffered output characters that triggers a flush, 0 disables buffering
+       @param line_buffered Flush output after every newline and before reading from standard input
+       @param cache Instance of ProgramCache, None disables caching
+       @param invalidate_cache Ignore and replace the cached entry for this program
+       @param profiler Instance of Profiler that measures the execution, None runs the program without profiling
+       @param statistics Instance of Statistics that is filled when the program ends, None disables statistics
+       @param optimize Rewrite the program by Optimizer (ignored for compiled programs)
+       @param limits Instance of Limits, None runs the program without limits
+       @return Instance of RunResult
+       @throws InterpretError Subclass with the return code of the error (XMLFormatError, OperandTypeError...)
+    '''
+    if not isinstance(program_source, Program):
+        program_source = compile_program(program_source, cache, invalidate_cache, optimize, limits=limits)
 
-    # Reading code from a file
+    program = program_source.copy(output_stream, error_stream)
+    program.profiler = profiler
+    program.limits = limits
+    program.count_instructions = statistics is not None
     try:
-        xml_root = xml_et.parse(source_file).getroot()
-    except xml_et.ParseError:
-        print("interpret.py: Malformed XML.", file=sys.stderr)
-        sys.exit(31)
-
-    source_file.close()
-    program = Program(xml_root)
-else:
-    # Reading code from stdin (source arg not set)
-    source = sys.stdin.read()
+        program.set_output(buffer_size, line_buffered)
+        if input_stream is not None:
+            program.set_input(input_stream)
+
+        program.execute()
+    except ProgramExit as program_exit:
+        return RunResult(program_exit.code)
+    finally:
+        program.close()
+        if statistics is not None:
+            statistics.insts = program.executed
+            statistics.vars = program.frameset.max_initialized
+
+    return RunResult(0)
+
+
+def interpret(source_file, input_file, output_stream, error_stream, args):
+    '''Runs one program with command line options
+
+       Calls run and turns errors into return codes reported to the error stream, so the caller decides whether the
+       process ends.
+       @param source_file Binary file object with the XML representation of the program or a compiled Program
+       @param input_file File object with inputs for READ instructions, None reads standard input
+       @param output_stream Text stream for the program output
+       @param error_stream Text stream for DPRINT, BREAK and error messages
+       @param args Instance of Args with the interpreter options
+       @return Return code of the interpretation
+    '''
+    cache = ProgramCache(args.cache_dir) if args.cache else None
+    profiler = Profiler() if args.profile is not False else None
+    statistics = Statistics() if args.stats is not False else None
     try:
-        xml_root = xml_et.fromstring(source)
-    except xml_et.ParseError:
-        print("interpret.py: Malformed XML.", file=sys.stderr)
-        sys.exit(31)
+        if not isinstance(source_file, Program):
+            source_file = compile_program(source_file, cache, args.invalidate_cache, args.optimize,
+                                          args.tier_threshold, args.limits)
+        if args.dump_program is not False:
+            try:
+                with open(args.dump_program, "w") as dump_file:
+                    source_file.dump(dump_file)
+            except OSError:
+                print("interpret.py: Program dump can't be written.", file=error_stream)
+
+        result = run(source_file, input_file, output_stream, error_stream, args.buffer_size, args.line_buffered,
+                     profiler=profiler, statistics=statistics, limits=args.limits)
+    except InterpretError as error:
+        print("interpret.py:", error, file=error_stream)
+        return error.code
+    finally:
+        if profiler is not None:
+            try:
+                profiler.write(args.profile)
+            except OSError:
+                print("interpret.py: Profile can't be written.", file=error_stream)
+        if statistics is not None:
+            try:
+                statistics.write(args.stats, args.stats_items)
+            except OSError:
+                print("interpret.py: Statistics can't be written.", file=error_stream)
+
+    return result.returncode
 
-    program = Program(xml_root)
 
-# Implicitly false until set
-if args.input_file is not False:
+def run_batch(args):
+    '''Batch mode
+
+       Runs all jobs from the manifest one after another in this process. Every job gets its own program, frames and
+       streams. Result of every job is printed to standard output as a line of JSON.
+       @param args Instance of Args with the interpreter options
+       @return 0 when all jobs have the expected return codes and outputs, 1 otherwise
+    '''
     try:
-        input_file = open(args.input_file)
+        with open(args.batch) as manifest:
+            lines = manifest.read().splitlines()
     except IOError:
-        print("interpret.py: File with input not found.", file=sys.stderr)
-        sys.exit(11)
+        print("interpret.py: Batch manifest not found.", file=sys.stderr)
+        return 11
+
+    base = os.path.dirname(os.path.abspath(args.batch))
+    all_passed = True
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+
+        # Missing fields are the same as "-"
+        fields = [field.strip() for field in line.split("\t")] + ["-"] * 3
+        (source_path, input_path, expected_path, expected_code) = [None if field in ("", "-") else field
+                                                                  for field in fields[:4]]
+        if source_path is not None:
+            source_path = os.path.join(base, source_path)
+        if input_path is not None:
+            input_path = os.path.join(base, input_path)
+
+        output = io.StringIO()
+        errors = io.StringIO()
+        try:
+            if source_path is None:
+                raise IOError("Source is missing in the manifest.")
+
+            with open(source_path, "rb") as source_file:
+                if input_path is None:
+                    code = interpret(source_file, io.BytesIO(), output, errors, args)
+                else:
+                    with open(input_path, "rb") as input_file:
+                        code = interpret(source_file, input_file, output, errors, args)
+        except IOError:
+            print("interpret.py: File with source code or input not found.", file=errors)
+            code = 11
+        except Exception:
+            # Internal error of the interpreter must not stop other jobs
+            errors.write(traceback.format_exc())
+            code = 99
+
+        result = {"source": source_path, "input": input_path, "returncode": code, "stdout": output.getvalue(),
+                  "stderr": errors.getvalue(), "passed": True}
+
+        # Problems with the expectations fail only this job, the reason is in "error"
+        if expected_code is not None:
+            try:
+                if not re.fullmatch(r"[+-]?[0-9]+", expected_code):
+                    raise ValueError(expected_code)
+                result["expected_returncode"] = int(expected_code)
+                result["passed"] = code == result["expected_returncode"]
+            except ValueError:
+                result["passed"] = False
+                result["error"] = "Expected return code {!r} is not an integer.".format(expected_code)
+
+        # Output is compared only for successful runs
+        if expected_path is not None and code == 0:
+            try:
+                with open(os.path.join(base, expected_path)) as expected_file:
+                    result["passed"] = result["passed"] and expected_file.read() == result["stdout"]
+            except OSError as error:
+                result["passed"] = False
+                result["error"] = "Expected output can't be read: {}".format(error.strerror or error)
+
+        all_passed = all_passed and result["passed"]
+        print(json.dumps(result))
+
+    return 0 if all_passed else 1
+
+
+class ServerStream:
+    '''Output stream of a server request
+
+       Text written by the program is collected and sent to the client as one JSON message when the stream is flushed.
+       OutputBuffer flushes after every write, so buffering of the program output is controlled by --buffer-size as
+       in one-shot runs.
+    '''
+    def __init__(self, connection_file, name):
+        '''ServerStream constructor
+
+           @param connection_file Text file object of the client connection
+           @param name Key of the messages - stdout or stderr
+        '''
+        self.connection_file = connection_file
+        self.name = name
+        self.parts = []
+
+    def write(self, text):
+        '''Collects text until the next flush
+
+           @param text String to write
+        '''
+        self.parts.append(text)
+
+    def flush(self):
+        '''Sends the collected text to the client'''
+        if self.parts:
+            self.connection_file.write(json.dumps({self.name: "".join(self.parts)}) + "\n")
+            self.parts = []
+        self.connection_file.flush()
 
-    program.set_input(input_file)
 
-# Now we have a program instance with instructions
-program.extract_instructions()
+class Server:
+    '''Interpreter daemon
 
-# Start the interpreter
-program.execute()
+       Listens on a Unix socket and runs programs sent by clients, so they don't pay for Python startup and XML
+       parsing. The socket is shared by a pool of worker processes that accept connections on their own. Every worker
+       keeps compiled programs in an LRU cache keyed by the SHA-256 hash of their XML, programs missing there are taken
+       from ProgramCache (unless --no-cache is given).
 
-# Close the input file if needed
-if program.stdin_file is not None:
-    program.stdin_file.close()
+       Every request is one line of JSON with the program as XML text in key "source" or a hash of an already sent
+       program in key "hash". Key "input" contains inputs for READ instructions (empty input when missing). Any number
+       of requests can be sent through one connection. Server answers with lines of JSON - {"stdout": text} and
+       {"stderr": text} as the output is produced and {"returncode": code, "hash": hash} at the end of the run.
+    '''
+    digest_pattern = re.compile(r"[0-9a-f]{64}")  # Hexadecimal SHA-256 digest, the only accepted form of "hash"
+
+    def __init__(self, args):
+        '''Server constructor
+
+           @param args Instance of Args with the socket path and the interpreter options
+        '''
+        self.args = args
+        self.cache = ProgramCache(args.cache_dir) if args.cache else None
+        self.programs = collections.OrderedDict()  # LRU cache of compiled programs - keys are hashes of sources
+        self.workers = []                          # Process IDs of workers
+        self.listener = None
+
+    def serve(self):
+        '''Runs the server
+
+           Creates the socket, starts workers and restarts the ones that end. Returns when the server is terminated by
+           SIGTERM or SIGINT, workers are stopped and the socket is removed.
+           @return Return code of the interpreter
+        '''
+        if os.path.exists(self.args.server):
+            # Socket left by a server that wasn't stopped properly, a running server still accepts connections
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.args.server)
+            except OSError:
+                os.remove(self.args.server)
+            else:
+                print("interpret.py: Server is already running on the socket.", file=sys.stderr)
+                return 12
+            finally:
+                probe.close()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.listener.bind(self.args.server)
+        except OSError:
+            print("interpret.py: Socket can't be created.", file=sys.stderr)
+            return 12
+        self.listener.listen(128)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for _ in range(self.args.workers):
+                self.start_worker()
+            while True:
+                (pid, _) = os.wait()
+                if pid in self.workers:
+                    self.workers.remove(pid)
+                    self.start_worker()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in self.workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            self.listener.close()
+            os.remove(self.args.server)
+
+        return 0
+
+    def start_worker(self):
+        '''Forks a worker process'''
+        pid = os.fork()
+        if pid != 0:
+            self.workers.append(pid)
+            return
+
+        # Worker is stopped by the server, SIGINT from the terminal is handled there
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            while True:
+                (connection, _) = self.listener.accept()
+                with connection:
+                    self.handle(connection)
+        finally:
+            os._exit(0)
 
-sys.exit(0)
+    def handle(self, connection):
+        '''Serves one client connection
+
+           @param connection Accepted socket
+        '''
+        try:
+            with connection.makefile("r", encoding="utf-8", newline="\n") as requests, \
+                    connection.makefile("w", encoding="utf-8", newline="\n") as responses:
+                for line in requests:
+                    if line.strip():
+                        self.handle_request(line, responses)
+        except (OSError, ValueError):
+            # Client closed the connection or sent invalid UTF-8
+            pass
+
+    def handle_request(self, line, responses):
+        '''Runs one request and sends the results
+
+           @param line Line of JSON with the request
+           @param responses Text file object of the client connection
+        '''
+        output = ServerStream(responses, "stdout")
+        errors = ServerStream(responses, "stderr")
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict) or not isinstance(request.get("source", request.get("hash")), str):
+            print("interpret.py: Invalid request.", file=errors)
+            self.respond(responses, output, errors, 10, None)
+            return
+
+        if "source" in request:
+            source = request["source"].encode("utf-8")
+            digest = hashlib.sha256(source).hexdigest()
+        else:
+            source = None
+            digest = request["hash"]
+
+        try:
+            program = self.get_program(digest, source)
+            if program is None:
+                print("interpret.py: Program {} isn't cached, send its source.".format(digest), file=errors)
+                code = 11
+            else:
+                input_file = io.BytesIO(str(request.get("input", "")).encode("utf-8"))
+                code = interpret(program, input_file, output, errors, self.args)
+        except InterpretError as error:
+            print("interpret.py:", error, file=errors)
+            code = error.code
+        except Exception:
+            # Internal error of the interpreter must not stop the worker
+            errors.write(traceback.format_exc())
+            code = 99
+
+        self.respond(responses, output, errors, code, digest)
+
+    @staticmethod
+    def respond(responses, output, errors, code, digest):
+        '''Sends the rest of the output and the end of the run
+
+           @param responses Text file object of the client connection
+           @param output ServerStream with the program output
+           @param errors ServerStream with the error output
+           @param code Return code of the run
+           @param digest Hash of the program, None when the request is invalid
+        '''
+        output.flush()
+        errors.flush()
+        responses.write(json.dumps({"returncode": code, "hash": digest}) + "\n")
+        responses.flush()
+
+    def get_program(self, digest, source):
+        '''Finds or compiles the requested program
+
+           @param digest Hash of the program source
+           @param source Program source as bytes, None when only the hash was sent
+           @return Compiled Program, None when only the hash was sent and the program isn't cached
+           @throws InterpretError When the sent program is invalid
+        '''
+        program = self.programs.get(digest)
+        if program is not None:
+            self.programs.move_to_end(digest)
+            return program
+
+        if source is not None:
+            program = compile_program(source, self.cache, self.args.invalidate_cache, self.args.optimize,
+                                      self.args.tier_threshold, self.args.limits)
+        elif self.cache is not None and self.digest_pattern.fullmatch(digest) is not None:
+            # Hash sent by the client becomes a file name, so only real SHA-256 digests are looked up
+            records = self.cache.load(digest)
+            if records is None:
+                return None
+            program = Program()
+            program.tier_threshold = self.args.tier_threshold
+            program.deserialize(records)
+            program.compile()
+            if self.args.optimize:
+                Optimizer(Limits.string_limit(self.args.limits)).optimize(program)
+        else:
+            return None
+
+        self.programs[digest] = program
+        if len(self.programs) > self.args.server_cache:
+            self.programs.popitem(last=False)
+
+        return program
+
+
+def main(argv=None):
+    '''Command line interface
+
+       Parses the arguments, opens the files and runs the program or the batch.
+       @param argv Command line arguments without the script name (sys.argv[1:] by default)
+       @return Return code of the interpreter
+    '''
+    args = Args()
+    args.parse(sys.argv[1:] if argv is None else argv)
+
+    if args.batch is not False:
+        return run_batch(args)
+
+    if args.server is not False:
+        return Server(args).serve()
+
+    # Implicitly false until set
+    if args.source_file is not False:
+        try:
+            source_file = open(args.source_file, "rb")
+        except IOError:
+            print("interpret.py: File with source code not found.", file=sys.stderr)
+            return 11
+    else:
+        # Reading code from stdin (source arg not set)
+        source_file = sys.stdin.buffer
+
+    # Implicitly false until set
+    input_file = None
+    if args.input_file is not False:
+        try:
+            input_file = open(args.input_file, "rb")
+        except IOError:
+            print("interpret.py: File with input not found.", file=sys.stderr)
+            if source_file is not sys.stdin.buffer:
+                source_file.close()
+            return 11
+
+    try:
+        return interpret(source_file, input_file, sys.stdout, sys.stderr, args)
+    finally:
+        # Close the files if needed
+        if source_file is not sys.stdin.buffer:
+            source_file.close()
+        if input_file is not None:
+            input_file.close()
+
+
+"""
+SCRIPT EXECUTION POINT
+"""
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""
+Project: IPP Project 1
+File: test.py
+Title: Parallel test runner
+Description: This script runs tests of parse.php and interpret.py on all processor cores and generates an HTML report
+Author: Michal Pospíšil (xpospi95@stud.fit.vutbr.cz)
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import html
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class TestCase:
+    '''Single test
+
+       Test is identified by a path to its .src file without the extension. Files .in, .out and .rc are optional,
+       missing files mean empty input, empty output and return code 0. Optional file .args contains additional
+       arguments of interpret.py, one per line.
+    '''
+    def __init__(self, path):
+        '''TestCase constructor
+
+           @param path Path to the test without the .src extension
+        '''
+        self.path = path
+        self.name = os.path.basename(path)
+        self.passed = False
+        self.returncode = None
+        self.expected_returncode = 0
+        self.output = ""
+        self.expected_output = ""
+        self.message = ""
+        self.duration = 0.0
+        self.mode = "both"
+
+    def read_file(self, extension, default):
+        '''Reads one of the test files
+
+           @param extension Extension of the file (with the dot)
+           @param default Value used when the file doesn't exist
+           @return Content of the file
+        '''
+        try:
+            with open(self.path + extension, encoding="utf-8") as test_file:
+                return test_file.read()
+        except IOError:
+            return default
+
+
+class TestRunner:
+    '''Runs tests in parallel
+
+       Every test runs the scripts as separate processes, tests are distributed among a pool of workers, so all
+       processor cores are used. Every process has a time limit.
+    '''
+    def __init__(self, options):
+        '''TestRunner constructor
+
+           @param options Parsed command line arguments
+        '''
+        self.options = options
+
+    def folder_mode(self, directory):
+        '''Decides how tests in a directory are run
+
+           Directories named int-only and parse-only (like in Tests/Examples) always contain tests of a single script,
+           other directories use the mode from the command line.
+           @param directory Path to the directory
+           @return One of "both", "int-only" and "parse-only"
+        '''
+        name = os.path.basename(os.path.normpath(directory))
+        if name in ("int-only", "parse-only"):
+            return name
+        elif self.options.int_only:
+            return "int-only"
+        elif self.options.parse_only:
+            return "parse-only"
+        return "both"
+
+    def find_tests(self):
+        '''Finds tests in the test directory
+
+           @return Dictionary where keys are directories and values are lists of TestCase sorted by name
+        '''
+        folders = {}
+        for (directory, subdirectories, files) in os.walk(self.options.directory):
+            subdirectories.sort()
+            if not self.options.recursive:
+                subdirectories.clear()
+
+            tests = [TestCase(os.path.join(directory, name[:-len(".src")])) for name in sorted(files)
+                     if name.endswith(".src")]
+            for test in tests:
+                test.mode = self.folder_mode(directory)
+            if tests:
+                folders[directory] = tests
+
+        return folders
+
+    def run_process(self, command, stdin_data, deadline):
+        '''Runs a script
+
+           @param command List with the command and its arguments
+           @param stdin_data Bytes passed to the standard input
+           @param deadline Time (from time.monotonic) when the test runs out of time
+           @return Tuple of return code and standard output, None when the time limit is exceeded
+        '''
+        try:
+            completed = subprocess.run(command, input=stdin_data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                       timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            return None
+        except OSError as error:
+            # Missing script or PHP interpreter, reported as a failed test
+            return (None, str(error).encode())
+
+        return (completed.returncode, completed.stdout)
+
+    def same_xml(self, test, deadline):
+        '''Compares XML output of parse.php with the expected output using JExamXML
+
+           @param test Instance of TestCase with the output
+           @param deadline Time (from time.monotonic) when the test runs out of time
+           @return True when JExamXML finds no differences
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, "output.xml")
+            with open(output_path, "w", encoding="utf-8") as output_file:
+                output_file.write(test.output)
+            command = ["java", "-jar", self.options.jexamxml, test.path + ".out", output_path,
+                       os.path.join(directory, "diffs.xml"), "/D"]
+            if self.options.jexamxml_options is not None:
+                command.append(self.options.jexamxml_options)
+            result = self.run_process(command, b"", deadline)
+
+        return result is not None and result[0] == 0
+
+    def run_test(self, test):
+        '''Runs a single test
+
+           Called by workers of the pool.
+           @param test Instance of TestCase
+           @return The same instance with results
+        '''
+        start = time.monotonic()
+        deadline = start + self.options.timeout
+        try:
+            test.expected_returncode = int(test.read_file(".rc", "0").strip() or 0)
+        except ValueError:
+            test.message = "File {}.rc doesn't contain a return code.".format(test.name)
+            return test
+        test.expected_output = test.read_file(".out", "")
+        input_path = test.path + ".in"
+        # Results must not depend on programs cached by earlier runs
+        interpreter = [sys.executable, self.options.int_script, "--no-cache",
+                       "--input=" + (input_path if os.path.exists(input_path) else os.devnull)]
+        interpreter += [argument for argument in test.read_file(".args", "").splitlines() if argument]
+
+        if test.mode == "int-only":
+            result = self.run_process(interpreter + ["--source=" + test.path + ".src"], b"", deadline)
+        else:
+            with open(test.path + ".src", "rb") as source_file:
+                result = self.run_process([self.options.php, self.options.parse_script], source_file.read(), deadline)
+            # Interpret only successfully parsed programs
+            if test.mode == "both" and result is not None and result[0] == 0:
+                result = self.run_process(interpreter, result[1], deadline)
+
+        test.duration = time.monotonic() - start
+        if result is None:
+            test.message = "Time limit of {} s exceeded.".format(self.options.timeout)
+            return test
+
+        test.returncode = result[0]
+        test.output = result[1].decode("utf-8", errors="replace")
+        if test.returncode is None:
+            test.message = "Script couldn't be run: {}".format(test.output)
+        elif test.returncode != test.expected_returncode:
+            test.message = "Return code {} was expected, got {}.".format(test.expected_returncode, test.returncode)
+        elif test.returncode == 0 and test.mode == "parse-only":
+            # XML can't be compared as text, it's left to JExamXML when it's available
+            if self.options.jexamxml is not None and not self.same_xml(test, deadline):
+                test.message = "JExamXML found differences in the output."
+            else:
+                test.passed = True
+        elif test.returncode == 0 and test.output != test.expected_output:
+            test.message = "Output differs from the expected output."
+        else:
+            test.passed = True
+
+        return test
+
+    def run(self):
+        '''Runs all tests
+
+           @return Dictionary where keys are directories and values are lists of finished tests
+        '''
+        folders = self.find_tests()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.options.jobs) as pool:
+            # Workers only wait for the processes, so threads are enough to keep all cores busy
+            futures = [pool.submit(self.run_test, test) for tests in folders.values() for test in tests]
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+
+        return folders
+
+
+class HTMLReport:
+    '''HTML report of test results
+
+       Uses the layout and the style sheet of HTML/index.html. The style sheet is included in the report, so the
+       report is a single file.
+    '''
+    def __init__(self, options, folders, duration):
+        '''HTMLReport constructor
+
+           @param options Parsed command line arguments
+           @param folders Dictionary with finished tests from TestRunner.run
+           @param duration Wall time of the whole test run in seconds
+        '''
+        self.options = options
+        self.folders = folders
+        self.duration = duration
+
+    @staticmethod
+    def style():
+        '''Reads the style sheet
+
+           @return Content of HTML/style.css next to this script, empty when it's missing
+        '''
+        try:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "HTML", "style.css")) as style_file:
+                return style_file.read()
+        except IOError:
+            return ""
+
+    def render_test(self, test):
+        '''Creates a section with one test
+
+           @param test Instance of TestCase
+           @return List of HTML lines
+        '''
+        lines = ['    <section class="test {}-test">'.format("ok" if test.passed else "failed"),
+                 '      <h4>{}</h4>'.format(html.escape(test.name)),
+                 '      <span>File: </span> <span>{}.src</span> <br>'.format(html.escape(test.path)),
+                 '      <span>Mode: </span> <span>{}</span> <br>'.format(test.mode),
+                 '      <span>Time: </span> <span>{:.3f} s</span> <br>'.format(test.duration)]
+        if not test.passed:
+            lines.append('      <span>Description:</span> <p>{}</p>'.format(html.escape(test.message)))
+            if test.returncode == 0 and test.expected_returncode == 0 and test.mode != "parse-only":
+                lines.append('      <h5>Expected output</h5> <pre>{}</pre>'.format(html.escape(test.expected_output)))
+                lines.append('      <h5>Output</h5> <pre>{}</pre>'.format(html.escape(test.output)))
+        lines.append('    </section>')
+
+        return lines
+
+    def render(self):
+        '''Creates the report
+
+           @return HTML document as a string
+        '''
+        total = sum(len(tests) for tests in self.folders.values())
+        passed = sum(test.passed for tests in self.folders.values() for test in tests)
+        lines = ['<!DOCTYPE HTML>',
+                 '<html lang="cs">',
+                 '  <head>',
+                 '    <meta charset="utf-8">',
+                 '    <meta name="viewport" content="width=device-width, initial-scale=1">',
+                 '    <title>IPP - Test results</title>',
+                 '    <style>',
+                 self.style(),
+                 '    </style>',
+                 '  </head>',
+                 '',
+                 '  <body>',
+                 '    <header>',
+                 '      <h1>IPP - Project 2</h1>',
+                 '      <h2>Test results</h2>',
+                 '      <span>Report generated: </span> <span>{}</span> <br>'.format(
+                     datetime.datetime.now().strftime("%d.%m.%Y %H:%M")),
+                 '      <span>Path - parser:</span> <span>{}</span> <br>'.format(
+                     html.escape(self.options.parse_script)),
+                 '      <span>Path - interpret:</span> <span>{}</span> <br>'.format(
+                     html.escape(self.options.int_script)),
+                 '      <span>Passed:</span> <span>{}/{}</span> <br>'.format(passed, total),
+                 '      <span>Time:</span> <span>{:.2f} s ({} workers)</span> <br>'.format(self.duration,
+                                                                                       self.options.jobs),
+                 '    </header>']
+
+        for (directory, tests) in sorted(self.folders.items()):
+            folder_passed = sum(test.passed for test in tests)
+            lines.extend(['    <section class="folder">',
+                          '      <header class="{}-folder">'.format("ok" if folder_passed == len(tests) else "failed"),
+                          '        <h3>{}</h3>'.format(html.escape(os.path.basename(directory))),
+                          '        <span>{}</span>'.format(html.escape(directory)),
+                          '        <span>{}/{} passed</span>'.format(folder_passed, len(tests)),
+                          '      </header>'])
+            for test in tests:
+                lines.extend(self.render_test(test))
+            lines.append('    </section>')
+
+        lines.extend(['  </body>', '</html>'])
+
+        return "\n".join(lines) + "\n"
+
+
+def main():
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Runs tests of parse.php and interpret.py in parallel and prints an "
+                                                 "HTML report. Test is a file .src with optional files .in (input), "
+                                                 ".out (expected output), .rc (expected return code) and .args "
+                                                 "(arguments of interpret.py, one per line).")
+    parser.add_argument("--directory", default=os.getcwd(), help="directory with tests (current directory by default)")
+    parser.add_argument("--recursive", action="store_true", help="search for tests in subdirectories too")
+    parser.add_argument("--parse-script", default=os.path.join(script_directory, "parse.php"),
+                        help="path to parse.php")
+    parser.add_argument("--int-script", default=os.path.join(script_directory, "interpret.py"),
+                        help="path to interpret.py")
+    parser.add_argument("--int-only", action="store_true",
+                        help="tests contain XML and are run by interpret.py only")
+    parser.add_argument("--parse-only", action="store_true", help="tests are run by parse.php only")
+    parser.add_argument("--jexamxml", help="path to jexamxml.jar, output of parse.php is compared by return code only "
+                                           "without it")
+    parser.add_argument("--jexamxml-options", help="path to the options file of JExamXML")
+    parser.add_argument("--php", default="php7.3", help="PHP interpreter for parse.php")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of tests run at once (number of processors by default)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="time limit of a test in seconds")
+    parser.add_argument("--report", help="write the report to a file instead of standard output")
+    options = parser.parse_args()
+    if options.int_only and options.parse_only:
+        parser.error("--int-only can't be combined with --parse-only")
+
+    if not os.path.isdir(options.directory):
+        print("test.py: Directory with tests not found.", file=sys.stderr)
+        sys.exit(11)
+
+    start = time.monotonic()
+    folders = TestRunner(options).run()
+    report = HTMLReport(options, folders, time.monotonic() - start).render()
+
+    if options.report is None:
+        sys.stdout.write(report)
+    else:
+        with open(options.report, "w", encoding="utf-8") as report_file:
+            report_file.write(report)
+
+    total = sum(len(tests) for tests in folders.values())
+    passed = sum(test.passed for tests in folders.values() for test in tests)
+    print("test.py: {}/{} tests passed in {:.2f} s.".format(passed, total, time.monotonic() - start), file=sys.stderr)
+    sys.exit(0 if passed == total else 1)
+
+
+if __name__ == "__main__":
+    main()